@@ -1,4 +1,6 @@
-import pandas as pd
+import os
+
+import numpy as np
 from datetime import datetime
 
 import plotly.express as px
@@ -6,12 +8,23 @@ import plotly.graph_objects as go
 import plotly.io as pio
 
 import dash
-from dash import html, dcc, dash_table
-from dash.dependencies import Input, Output
+from dash import html, dcc, dash_table, ctx, Patch
+from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 from dash.dash_table.Format import Format, Scheme
 from dash.dash_table import DataTable, FormatTemplate
 import dash_bootstrap_components as dbc
 
+import aggregates
+import compression
+import data_store
+import downsample
+import geometry
+import ingest
+import metrics
+from figure_cache import FigureCache
+from snapshot import BackgroundRefresher, DataSnapshot, SnapshotHolder
+
 app = dash.Dash(__name__,
                 external_stylesheets=[dbc.themes.CYBORG],
                 # meta_tags=[
@@ -22,284 +35,350 @@ app = dash.Dash(__name__,
 
 # --------------------------------------------------------------------------------------------------------------
 
-# load data
-country_daily_df = pd.read_csv('https://github.com/dknight26275/Covid19Dashboard/raw/main/country_daily.csv')
-country_latest_df = pd.read_csv('https://github.com/dknight26275/Covid19Dashboard/raw/main/country_latest.csv')
-daily_total_df = pd.read_csv('https://github.com/dknight26275/Covid19Dashboard/raw/main/daily_total.csv')
-
-# sort, filter and group the daily_total_df for global bar charts
-global_bar_df = daily_total_df.copy()
-global_bar_df['Date'] = pd.to_datetime(global_bar_df['Date'], infer_datetime_format=True)
-# sort by Date
-global_bar_df = global_bar_df.sort_values('Date', ignore_index=True)
-# group data by week
-global_df_weekly = global_bar_df.groupby(by=[pd.Grouper(key='Date', axis=0, freq='W')])[
-    ['Date', 'Confirmed', 'Deaths', 'New_cases', 'New_deaths']].agg({
-    'Confirmed': 'max',  # No of confirmed cases at the end of the week
-     'Deaths': 'max',  # No of deaths  at the end of the week
-     'New_cases': 'sum',  # number of new cases each day throughout the week
-     'New_deaths': 'sum'}  # number of new deaths each day throughout the week
-).reset_index()  # flatten multi-index for px
-
-country_bar_df = country_latest_df.copy()
-country_bar_df = country_bar_df.rename(columns={'Country_Region':'Country','Confirmed': 'Confirmed cases',
-                                                'Deaths_per_100':'Fatality rate',
-                                                'Cases_per_million':'Cases/1 million population',
-                                                'New_cases_last_month':'28 day cases',
-                                                'New_deaths_last_month':'28 day deaths',})
-
-
-# initialise variables
-global_total_cases = int(country_latest_df['Confirmed'].sum())
-global_total_deaths = int(country_latest_df['Deaths'].sum())
-cases_per_million = int(country_latest_df['Cases_per_million'].mean())
-deaths_per_100 = country_latest_df['Deaths_per_100'].mean()
-cases_last_month = int(country_latest_df['New_cases_last_month'].sum())
-cases_one_month_change_pc = (cases_last_month / global_total_cases) * 100
-deaths_last_month = int(country_latest_df['New_deaths_last_month'].sum())
-deaths_one_month_change_pc = (deaths_last_month / global_total_deaths) * 100
-cases_last_week = int(country_latest_df['New_cases_last_week'].sum())
-cases_one_week_change_pc = (cases_last_week / global_total_cases) * 100
-deaths_last_week = int(country_latest_df['New_deaths_last_week'].sum())
-deaths_one_week_change_pc = (deaths_last_week / global_total_deaths) * 100
-
-# convert latest date in df to 'Month day year' format
-dateparts = daily_total_df['Date'].iloc[-1].split('-')
-last_update = datetime(int(dateparts[0]), int(dateparts[1]), int(dateparts[2]))
-last_update = last_update.strftime('%B %d %Y')
+# load data from the local column cache (see data_store.py), downloading from github only when it is stale.
+# Set COVID_DASHBOARD_OFFLINE=1 to run from the bundled csv files without network access.
+# Daily rows ingested since the csv files were published (see ingest.py) are applied on top.
+with metrics.span('startup'):
+    frames = ingest.catch_up(ingest.DailyFrames(*data_store.load_frames()))
+# callbacks and the layout read the current snapshot, swapped atomically when new data is ingested
+data = SnapshotHolder(DataSnapshot.from_frames(frames))
+
+# serialized figures keyed on callback inputs, dropped whenever the loaded data changes
+figure_cache = FigureCache(max_entries=int(os.environ.get('COVID_DASHBOARD_FIGURE_CACHE_ENTRIES', 256)),
+                           max_bytes=int(os.environ.get('COVID_DASHBOARD_FIGURE_CACHE_BYTES', 64 * 1024 * 1024)))
+data.on_swap(lambda snapshot: figure_cache.set_version(snapshot.version))
+
+# brotli/gzip compressed responses, with the compressed bodies cached on the same terms (see compression.py)
+response_cache = compression.ResponseCache(
+    max_entries=int(os.environ.get('COVID_DASHBOARD_RESPONSE_CACHE_ENTRIES', 512)),
+    max_bytes=int(os.environ.get('COVID_DASHBOARD_RESPONSE_CACHE_BYTES', 32 * 1024 * 1024)))
+data.on_swap(lambda snapshot: response_cache.set_version(snapshot.version))
+compression.init_app(app, response_cache)
+
+# check for newly published dates in the background (COVID_DASHBOARD_REFRESH_INTERVAL), in every worker process
+refresher = BackgroundRefresher(data)
+app.server.before_request(refresher.ensure_started)
 
 dths = '#A32323'  # colour for styling deaths
 conf = '#4B9D3E'  # colour for styling confirmed cases
 
 # Data Card
-global_data_card = dbc.Card(
-    children=[
-        dbc.CardHeader("Total COVID19 cases and deaths globally"),
-        dbc.CardBody(
-            children=[
-                dbc.ListGroup(
-                    children=[
-                        dbc.ListGroupItem("Total confirmed cases:  {:,}".format(global_total_cases)),
-                        dbc.ListGroupItem("Total COVID 19 related deaths: {:,}".format(global_total_deaths)),
-                        dbc.ListGroupItem("COVID 19 cases per million people: {:,}".format(cases_per_million)),
-                        dbc.ListGroupItem("COVID 19 deaths/100 cases: {:.2f}".format(deaths_per_100)),
-                        dbc.ListGroupItem(
-                            "Confirmed cases in the last month: {:,} ({:+.2f}%)".format(
-                                cases_last_month, cases_one_month_change_pc)),
-                        dbc.ListGroupItem(
-                            "COVID 19 deaths in the last month: {:,} ({:+.2f}%)".format(
-                                deaths_last_month, deaths_one_month_change_pc)),
-                        dbc.ListGroupItem(
-                            "Confirmed cases in the last week: {:,} ({:+.2f}%)".format(
-                                cases_last_week, cases_one_week_change_pc)),
-                        dbc.ListGroupItem(
-                            "COVID 19 deaths in the last week: {:,} ({:+.2f}%)".format(
-                                deaths_last_week, deaths_one_week_change_pc)),
-                    ],
-                    className='card-text'
-                )
-            ]
-        ),
-    ],
-    className='card text-white bg-secondary mb-3'
-)
+def make_continent_table(breakdown):
+    return dbc.Table(
+        [html.Thead(html.Tr([html.Th(label) for label in ['Continent', 'Cases', 'Deaths', 'Cases/1M', 'Deaths/100']])),
+         html.Tbody([
+            html.Tr([html.Td(continent),
+                     html.Td('{:,}'.format(stats['global_total_cases'])),
+                     html.Td('{:,}'.format(stats['global_total_deaths'])),
+                     html.Td('{:,}'.format(stats['cases_per_million'])),
+                     html.Td('{:.2f}'.format(stats['deaths_per_100']))])
+            for continent, stats in breakdown.items()
+         ])],
+        size='sm',
+        className='card-text text-white'
+    )
+
+
+# summary and breakdown as returned by DataSnapshot.summary(); filtered when they follow a table filter
+def make_data_card(summary, breakdown, filtered=False):
+    if filtered:
+        header = "COVID19 cases and deaths in the {:,} countries matching the table filter".format(summary['countries'])
+    else:
+        header = "Total COVID19 cases and deaths globally"
+    return dbc.Card(
+        children=[
+            dbc.CardHeader(header),
+            dbc.CardBody(
+                children=[
+                    dbc.ListGroup(
+                        children=[
+                            dbc.ListGroupItem("Total confirmed cases:  {:,}".format(summary['global_total_cases'])),
+                            dbc.ListGroupItem("Total COVID 19 related deaths: {:,}".format(summary['global_total_deaths'])),
+                            dbc.ListGroupItem("COVID 19 cases per million people: {:,}".format(summary['cases_per_million'])),
+                            dbc.ListGroupItem("COVID 19 deaths/100 cases: {:.2f}".format(summary['deaths_per_100'])),
+                            dbc.ListGroupItem(
+                                "Confirmed cases in the last month: {:,} ({:+.2f}%)".format(
+                                    summary['cases_last_month'], summary['cases_one_month_change_pc'])),
+                            dbc.ListGroupItem(
+                                "COVID 19 deaths in the last month: {:,} ({:+.2f}%)".format(
+                                    summary['deaths_last_month'], summary['deaths_one_month_change_pc'])),
+                            dbc.ListGroupItem(
+                                "Confirmed cases in the last week: {:,} ({:+.2f}%)".format(
+                                    summary['cases_last_week'], summary['cases_one_week_change_pc'])),
+                            dbc.ListGroupItem(
+                                "COVID 19 deaths in the last week: {:,} ({:+.2f}%)".format(
+                                    summary['deaths_last_week'], summary['deaths_one_week_change_pc'])),
+                        ],
+                        className='card-text'
+                    ),
+                    make_continent_table(breakdown),
+                ]
+            ),
+        ],
+        className='card text-white bg-secondary mb-3'
+    )
+
+
 # --------------------------------------------------------------------------------------------------------------
 #APP Layout
 
-app.layout = dbc.Container(
-    children=[
-        html.Div(
-            id='banner',
-            children=[
-                dbc.Row(
-                    [
-                        dbc.Col(
-                            html.A(
-                                [html.H5('Data sourced from JHU CSSE', style={'text-align': 'center',
-                                                                              'color': 'white',
-                                                                              'font-style': 'italic'})],
-                                href="https://github.com/CSSEGISandData/COVID-19",
-                                className='nav-item'
+# daily/weekly/monthly bars, served from the precomputed rollups (see aggregates.py)
+def make_granularity_selector(component_id):
+    return dcc.RadioItems(
+        id=component_id,
+        options=[{'label': ' {} '.format(label), 'value': granularity}
+                 for granularity, (label, _) in aggregates.GRANULARITIES.items()],
+        value=aggregates.DEFAULT_GRANULARITY,
+        inputClassName='form-check-input',
+        labelStyle={
+            'padding': '10px'
+        }
+    )
+
+
+def serve_layout():
+    # built per page load so the summary card and last updated date follow the current snapshot
+    snapshot = data.current()
+    return dbc.Container(
+        children=[
+            html.Div(
+                id='banner',
+                children=[
+                    dbc.Row(
+                        [
+                            dbc.Col(
+                                html.A(
+                                    [html.H5('Data sourced from JHU CSSE', style={'text-align': 'center',
+                                                                                  'color': 'white',
+                                                                                  'font-style': 'italic'})],
+                                    href="https://github.com/CSSEGISandData/COVID-19",
+                                    className='nav-item'
+                                ),
+                                width=2,
+                                style={"height": "100%"},
+                                className='nav-link'
                             ),
-                            width=2,
-                            style={"height": "100%"},
-                            className='nav-link'
-                        ),
-                        dbc.Col(
-                            html.H1('COVID19 Pandemic Dashboard', style={'text-align': 'center',
-                                                                         'color': 'white',
-                                                                         'font-weight': 'bold'}),
-                            width=8,
-                            style={"height": "50%"},
-                            # className='nav-link active'
-                        ),
-                        dbc.Col(
-                            [html.H4('Last updated: ', style={'text-align': 'center',
-                                                              'color': 'white',
-                                                              'font-weight': 'bold'}),
-                             html.P('{}'.format(last_update), style={'text-align': 'center',
-                                                                     'color': 'white'}, )],
-                            width=2,
-                            style={"height": "100%", },
-                        )
-                    ],
-                    className=['h-100', 'w-100', ]
-                ),
-            ],
-            style={'height': '10%', },
-            className='navbar navbar-expand-lg navbar-dark bg-primary'
-        ),
-        html.Div(
-            id='data-container',
-            children=[
-                dbc.Row(
-                    children=[
-                        dbc.Col(
-                            id='confirmed_chart_container',
-                            children=[
-                                # html.H5('Global cases barchart'),
-                                dcc.RadioItems(
-                                    id='weekly_vs_cumulative_cases_selector',
-                                    options=
-                                    [
-                                        {'label': ' Cumulative ', 'value': 'Confirmed'},
-                                        {'label': ' Weekly ', 'value': 'New_cases'}
-                                    ],
-                                    value='New_cases',
-                                    inputClassName='form-check-input',
-                                    labelStyle={
-                                        'padding': '10px'
-                                    }
+                            dbc.Col(
+                                html.H1('COVID19 Pandemic Dashboard', style={'text-align': 'center',
+                                                                             'color': 'white',
+                                                                             'font-weight': 'bold'}),
+                                width=8,
+                                style={"height": "50%"},
+                                # className='nav-link active'
+                            ),
+                            dbc.Col(
+                                [html.H4('Last updated: ', style={'text-align': 'center',
+                                                                  'color': 'white',
+                                                                  'font-weight': 'bold'}),
+                                 html.P('{}'.format(snapshot.last_update), style={'text-align': 'center',
+                                                                         'color': 'white'}, )],
+                                width=2,
+                                style={"height": "100%", },
+                            )
+                        ],
+                        className=['h-100', 'w-100', ]
+                    ),
+                ],
+                style={'height': '10%', },
+                className='navbar navbar-expand-lg navbar-dark bg-primary'
+            ),
+            html.Div(
+                id='data-container',
+                children=[
+                    dbc.Row(
+                        children=[
+                            dbc.Col(
+                                # date range of both bar charts, the whole series by default
+                                dcc.DatePickerRange(
+                                    id='chart_date_range',
+                                    min_date_allowed=snapshot.global_rollups.first_date.date(),
+                                    max_date_allowed=snapshot.global_rollups.last_date.date(),
+                                    initial_visible_month=snapshot.global_rollups.last_date.date(),
+                                    display_format='MMM D YYYY',
+                                    clearable=True,
                                 ),
-                                dcc.Graph(id='confirmed_cases_barchart', figure={}),
-                            ],
-                            width=4,
-                            # style={'height': '50%',}
-                        ),
-                        dbc.Col(
-                            id='deaths_chart_container',
-                            children=[
-                                # html.H5('Global cases barchart'),
+                                width=4,
+                            ),
+                            dbc.Col(
                                 dcc.RadioItems(
-                                    id='weekly_vs_cumulative_deaths_selector',
-                                    options=
-                                    [
-                                        {'label': ' Cumulative ', 'value': 'Deaths'},
-                                        {'label': ' Weekly ', 'value': 'New_deaths'}
-                                    ],
-                                    value='New_deaths',
+                                    id='chart_style_selector',
+                                    options=[{'label': ' {} '.format(label), 'value': style}
+                                             for style, label in downsample.CHART_STYLES.items()],
+                                    value=downsample.DEFAULT_CHART_STYLE,
                                     inputClassName='form-check-input',
                                     labelStyle={
                                         'padding': '10px'
                                     }
                                 ),
-                                dcc.Graph(id='deaths_barchart', figure={}),
-                            ],
-                            width=4,
-                            # style={'height': '50%',}
-                        ),
-                        dbc.Col(
-                            id='summary_stats_container',
-                            children=[
-                                global_data_card,
-                            ],
-                            width=4,
-                            # className='card text-white bg-secondary mb-3'
-                        )
-                    ]
-
-                ),
-                dbc.Row(
-                    children=[
-                        dbc.Col(
-                            id='datatable_container',
-                            children=[
-                                dash_table.DataTable(
-                                    id='interactive_datable',
-                                    columns=[
-                                        dict(name='Country', id='Country', selectable=False, deletable=False,
-                                             type='text', ),
-                                        dict(name='Confirmed cases', id='Confirmed cases', selectable=True,
-                                             deletable=False, type='numeric', format=Format().group(True)),
-                                        dict(name='Deaths', id='Deaths', selectable=True,
-                                             deletable=False, type='numeric', format=Format().group(True)),
-                                        dict(name='Fatality rate', id='Fatality rate', selectable=True,
-                                             deletable=False, type='numeric', format=FormatTemplate.percentage(2)),
-                                        dict(name='Cases/1 million population', id='Cases/1 million population', selectable=True,
-                                             deletable=False, type='numeric',
-                                             format=Format(precision=2, scheme=Scheme.fixed)),
-                                        dict(name='28 day cases', id='28 day cases', selectable=True,
-                                             deletable=False, type='numeric', format=Format().group(True)),
-                                        dict(name='28 day deaths', id='28 day deaths', selectable=True,
-                                             deletable=False, type='numeric', format=Format().group(True)),
-                                    ],
-                                    data=country_bar_df.to_dict('records'),
-                                    editable=False,
-                                    filter_action='native',
-                                    sort_action='native',
-                                    sort_mode='single',
-                                    column_selectable='single',
-                                    row_selectable='single',
-                                    row_deletable=False,
-                                    selected_columns=[],
-                                    selected_rows=[],
-                                    page_action='native',
-                                    page_current=0,
-                                    page_size=10,
-                                    # style_data={
-                                    #     'whiteSpace': 'normal', 'height': 'auto'
-                                    # },
-                                    style_cell_conditional=[
-                                        {
-                                            'if': {'column_id': 'Country_Region'},
-                                            'textAlign': 'left'
+                                width=4,
+                            ),
+                        ]
+                    ),
+                    dbc.Row(
+                        children=[
+                            dbc.Col(
+                                id='confirmed_chart_container',
+                                children=[
+                                    # html.H5('Global cases barchart'),
+                                    dcc.RadioItems(
+                                        id='weekly_vs_cumulative_cases_selector',
+                                        options=
+                                        [
+                                            {'label': ' Cumulative ', 'value': 'Confirmed'},
+                                            {'label': ' New ', 'value': 'New_cases'}
+                                        ],
+                                        value='New_cases',
+                                        inputClassName='form-check-input',
+                                        labelStyle={
+                                            'padding': '10px'
+                                        }
+                                    ),
+                                    make_granularity_selector('cases_granularity_selector'),
+                                    dcc.Graph(id='confirmed_cases_barchart', figure={}),
+                                    # dates the chart is zoomed into, None when it shows the picked range
+                                    dcc.Store(id='cases_zoom', data=None),
+                                ],
+                                width=4,
+                                # style={'height': '50%',}
+                            ),
+                            dbc.Col(
+                                id='deaths_chart_container',
+                                children=[
+                                    # html.H5('Global cases barchart'),
+                                    dcc.RadioItems(
+                                        id='weekly_vs_cumulative_deaths_selector',
+                                        options=
+                                        [
+                                            {'label': ' Cumulative ', 'value': 'Deaths'},
+                                            {'label': ' New ', 'value': 'New_deaths'}
+                                        ],
+                                        value='New_deaths',
+                                        inputClassName='form-check-input',
+                                        labelStyle={
+                                            'padding': '10px'
+                                        }
+                                    ),
+                                    make_granularity_selector('deaths_granularity_selector'),
+                                    dcc.Graph(id='deaths_barchart', figure={}),
+                                    dcc.Store(id='deaths_zoom', data=None),
+                                ],
+                                width=4,
+                                # style={'height': '50%',}
+                            ),
+                            dbc.Col(
+                                id='summary_stats_container',
+                                children=[
+                                    make_data_card(*snapshot.summary()),
+                                ],
+                                width=4,
+                                # className='card text-white bg-secondary mb-3'
+                            )
+                        ]
+
+                    ),
+                    dbc.Row(
+                        children=[
+                            dbc.Col(
+                                id='datatable_container',
+                                children=[
+                                    dash_table.DataTable(
+                                        id='interactive_datable',
+                                        columns=[
+                                            dict(name='Country', id='Country', selectable=False, deletable=False,
+                                                 type='text', ),
+                                            dict(name='Confirmed cases', id='Confirmed cases', selectable=True,
+                                                 deletable=False, type='numeric', format=Format().group(True)),
+                                            dict(name='Deaths', id='Deaths', selectable=True,
+                                                 deletable=False, type='numeric', format=Format().group(True)),
+                                            dict(name='Fatality rate', id='Fatality rate', selectable=True,
+                                                 deletable=False, type='numeric', format=FormatTemplate.percentage(2)),
+                                            dict(name='Cases/1 million population', id='Cases/1 million population', selectable=True,
+                                                 deletable=False, type='numeric',
+                                                 format=Format(precision=2, scheme=Scheme.fixed)),
+                                            dict(name='28 day cases', id='28 day cases', selectable=True,
+                                                 deletable=False, type='numeric', format=Format().group(True)),
+                                            dict(name='28 day deaths', id='28 day deaths', selectable=True,
+                                                 deletable=False, type='numeric', format=Format().group(True)),
+                                        ],
+                                        data=[],
+                                        editable=False,
+                                        filter_action='custom',
+                                        filter_query='',
+                                        sort_action='custom',
+                                        sort_by=[],
+                                        sort_mode='single',
+                                        column_selectable='single',
+                                        row_selectable='multi',
+                                        row_deletable=False,
+                                        selected_columns=[],
+                                        selected_rows=[],
+                                        selected_row_ids=[],
+                                        page_action='custom',
+                                        page_current=0,
+                                        page_size=10,
+                                        # style_data={
+                                        #     'whiteSpace': 'normal', 'height': 'auto'
+                                        # },
+                                        style_cell_conditional=[
+                                            {
+                                                'if': {'column_id': 'Country_Region'},
+                                                'textAlign': 'left'
+                                            },
+                                        ],
+                                        style_header={
+                                            'backgroundColor': 'rgb(42,159,214)',
+                                            'color': '#fff',
+                                            'height':'auto',
+                                            'whiteSpace':'normal'
                                         },
-                                    ],
-                                    style_header={
-                                        'backgroundColor': 'rgb(42,159,214)',
-                                        'color': '#fff',
-                                        'height':'auto',
-                                        'whiteSpace':'normal'
-                                    },
-                                    style_cell={
-                                        'minWidth': 125,
-                                        'maxWidth':150,
-                                        'width':95,
-                                        'height': 'auto',
-                                        'whiteSpace': 'normal'
-                                    },
-                                    style_data={
-                                        'backgroundColor': '#adafae',
-                                        'color': 'black',
-                                    },
-                                    # style_data_conditional=[
-                                    #     {
-                                    #         'if': {'row_index': 'odd'},
-                                    #         'backgroundColor': 'rgb(220, 220, 220)',
-                                    #     }
-                                    # ],
-                                ),
+                                        style_cell={
+                                            'minWidth': 125,
+                                            'maxWidth':150,
+                                            'width':95,
+                                            'height': 'auto',
+                                            'whiteSpace': 'normal'
+                                        },
+                                        style_data={
+                                            'backgroundColor': '#adafae',
+                                            'color': 'black',
+                                        },
+                                        # style_data_conditional=[
+                                        #     {
+                                        #         'if': {'row_index': 'odd'},
+                                        #         'backgroundColor': 'rgb(220, 220, 220)',
+                                        #     }
+                                        # ],
+                                    ),
+                                    # countries selected in the table, on any of its pages
+                                    dcc.Store(id='selected_countries', data=[]),
+                                    # the page the table shows: its page/filter/sort and the ids of its rows
+                                    dcc.Store(id='table_page', data=None),
+
+                                ],
+                                className='table table-hover'
+                            ),
+                            dbc.Col(
+                                id='map_container',
+                                children=[
+                                    dcc.Graph(id='choropleth_map', figure={},),
+                                    # outline resolution for the current zoom level of the map
+                                    dcc.Store(id='map_resolution', data=geometry.DEFAULT_RESOLUTION),
+                                ],
+
+                                # style={'height': '100%', 'backgroundColor':'white'},
+                            ),
+                        ]
+                    ),
+                ],
+
+            ),
+        ],
+        id='root',
+        style={'max-width': '100vw', 'max-height': '100vh'}
+    )
 
-                            ],
-                            className='table table-hover'
-                        ),
-                        dbc.Col(
-                            id='map_container',
-                            children=[
-                                dcc.Graph(id='choropleth_map', figure={},),
-                            ],
-
-                            # style={'height': '100%', 'backgroundColor':'white'},
-                        ),
-                    ]
-                ),
-            ],
-
-        ),
-    ],
-    id='root',
-    style={'max-width': '100vw', 'max-height': '100vh'}
-)
+
+app.layout = serve_layout
 
 
 
@@ -309,133 +388,195 @@ app.layout = dbc.Container(
 # # Connect the Plotly graphs with Dash Components
 #
 # #confirmed cases barcharts
+def series_chart(df, selected_barchart, label, colour, chart_style, revision, **trace_style):
+    """Bar chart, or WebGL line chart, of df[selected_barchart] by date, within the chart point budget."""
+    if chart_style == 'webgl':
+        # a line keeps the shape of the series with the budget's most significant points
+        df = downsample.lttb_frame(df, selected_barchart)
+        chart = go.Figure(go.Scattergl(x=df['Date'], y=df[selected_barchart], mode='lines', fill='tozeroy',
+                                       line={'color': colour, 'width': 1},
+                                       hovertemplate='Date=%{x}<br>' + label + '=%{y}<extra></extra>'))
+        chart.update_layout({'template': 'plotly_dark', 'xaxis_title': 'Date', 'yaxis_title': label})
+    else:
+        chart = px.bar(df
+                       , x='Date'
+                       , y=selected_barchart
+                       , opacity=0.9
+                       , orientation='v'
+                       , barmode='relative'
+                       # , title='Global COVID19 {}'.format(selected_barchart)
+                       , hover_data=['Date', selected_barchart]
+                       , template='plotly_dark'
+                       , labels={'Date': 'Date',
+                                 selected_barchart: label})
+        chart.update_traces(marker_color=colour, **trace_style)
+
+    chart.update_layout({'font': {'family': 'arial', 'size': 12},
+                         'plot_bgcolor': 'rgba(0,0,0,0)',
+                         'paper_bgcolor': 'rgba(0,0,0,0)',
+                         # a redraw for a zoomed range keeps the user's zoom, a new date range or granularity resets it
+                         'uirevision': revision,
+                         }
+                        )
+    chart.update_yaxes(showgrid=False, tickfont={'family': 'arial', 'size': 12}, linecolor='white')
+    chart.update_xaxes(showgrid=False, tickfont={'family': 'arial', 'size': 12}, linecolor='white')
+    return chart
+
+
+def chart_frame(rollups, granularity, start_date, end_date, zoom, chart_style, keys=None):
+    """Rows drawn by a chart: the zoomed range if any, else the picked one, within the point budget for bars."""
+    start, end = zoom or (start_date, end_date)
+    # lines are downsampled from every period by series_chart
+    max_points = None if chart_style == 'webgl' else downsample.MAX_POINTS
+    return rollups.frame(granularity, start, end, keys=keys, max_points=max_points)
+
+
+# plotly express fills in its shared template objects on first use, which is not thread safe: concurrent
+# first charts (several browsers opening the page on a fresh worker) could fail. Build one before serving.
+series_chart(chart_frame(data.current().global_rollups, aggregates.DEFAULT_GRANULARITY, None, None, None,
+                         downsample.DEFAULT_CHART_STYLE),
+             'New_cases', 'Covid19 cases', conf, downsample.DEFAULT_CHART_STYLE, revision=None)
+
+
+def next_zoom(relayout_data, zoom):
+    """The zoom store after an event of the chart or of its range controls."""
+    if ctx.triggered_id not in ('confirmed_cases_barchart', 'deaths_barchart'):
+        # a new date range or granularity redraws the whole range
+        if zoom is None:
+            raise PreventUpdate
+        return None
+    if 'xaxis.range[0]' in relayout_data:
+        return [relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']]
+    if 'xaxis.range' in relayout_data:
+        return list(relayout_data['xaxis.range'])
+    if relayout_data.get('xaxis.autorange') and zoom is not None:
+        return None
+    # panning the y axis, resizing...
+    raise PreventUpdate
+
+
+@app.callback(
+    Output(component_id='cases_zoom', component_property='data'),
+    [Input(component_id='confirmed_cases_barchart', component_property='relayoutData'),
+     Input(component_id='cases_granularity_selector', component_property='value'),
+     Input(component_id='chart_date_range', component_property='start_date'),
+     Input(component_id='chart_date_range', component_property='end_date')],
+    [State(component_id='cases_zoom', component_property='data')]
+)
+@metrics.timed
+def update_cases_zoom(relayout_data, granularity, start_date, end_date, zoom):
+    return next_zoom(relayout_data or {}, zoom)
+
+
 @app.callback(
     Output(component_id='confirmed_cases_barchart', component_property='figure'),
     [Input(component_id='weekly_vs_cumulative_cases_selector', component_property='value'),
-     Input(component_id='interactive_datable', component_property='derived_virtual_selected_rows')]
+     Input(component_id='cases_granularity_selector', component_property='value'),
+     Input(component_id='chart_date_range', component_property='start_date'),
+     Input(component_id='chart_date_range', component_property='end_date'),
+     Input(component_id='cases_zoom', component_property='data'),
+     Input(component_id='chart_style_selector', component_property='value'),
+     Input(component_id='selected_countries', component_property='data')]
 )
-def update_cases_barchart(selected_barchart, selected_rows):
+@metrics.timed
+def update_cases_barchart(selected_barchart, granularity, start_date, end_date, zoom, chart_style,
+                          selected_countries):
     # print(selected_barchart)
-    #get list of selected countries from datatable
-    if len(selected_rows) == 0: # len will == 0 if no countries selected
-        df = global_df_weekly
+    snapshot = data.current()
+    # rows of the datatable are identified by country name
+    selected_countries = selected_countries or []
+    if not any(country in snapshot.country_rollups for country in selected_countries):
+        df = chart_frame(snapshot.global_rollups, granularity, start_date, end_date, zoom, chart_style)
     else:
-        # can't use global_df_weekly, it doesn't have country column, need to use country daily...
-        dff = country_daily_df.iloc[selected_rows[0],:]
-
-        # convert date colum to datetime format
-        dff['Date'] = pd.to_datetime(dff['Date'], infer_datetime_format=True)
-        # sort by Date
-        dff = dff.sort_values('Date', ignore_index=True)
-        # group data by week
-        df = dff.groupby(by=[pd.Grouper(key='Date', axis=0, freq='W')])[
-            ['Date', 'Confirmed', 'Deaths', 'New_cases', 'New_deaths']].agg({
-            'Confirmed': 'max',  # No of confirmed cases at the end of the week
-            'Deaths': 'max',  # No of deaths  at the end of the week
-            'New_cases': 'sum',  # number of new cases each day throughout the week
-            'New_deaths': 'sum'}  # number of new deaths each day throughout the week
-        ).reset_index()  # flatten multi-index for px
-
-
-    cases_barchart = px.bar(df
-                            , x='Date'
-                            , y=selected_barchart
-                            , opacity=0.9
-                            , orientation='v'
-                            , barmode='relative'
-                            # , title='Global COVID19 {}'.format(selected_barchart)
-                            , hover_data=['Date', selected_barchart]
-                            , template='plotly_dark'
-                            , labels={'Date': 'Date',
-                                      selected_barchart: 'Covid19 cases'})
-
-    cases_barchart.update_layout({'font': {'family': 'arial', 'size': 12},
-                                  'plot_bgcolor': 'rgba(0,0,0,0)',
-                                  'paper_bgcolor': 'rgba(0,0,0,0)'
-                                  }
-                                 )
-    cases_barchart.update_yaxes(showgrid=False, tickfont={'family': 'arial', 'size': 12}, linecolor='white')
-    cases_barchart.update_xaxes(showgrid=False, tickfont={'family': 'arial', 'size': 12}, linecolor='white')
-    cases_barchart.update_traces(marker_color=conf)
-
-    return cases_barchart
+        # totals of the selected countries, summed if more than one is selected
+        df = chart_frame(snapshot.country_rollups, granularity, start_date, end_date, zoom, chart_style,
+                         keys=selected_countries)
+    return series_chart(df, selected_barchart, 'Covid19 cases', conf, chart_style,
+                        revision='{}/{}/{}'.format(granularity, start_date, end_date))
 
 
 # deaths barcharts
+@figure_cache.memoize
+def deaths_figure(selected_barchart, granularity, start_date, end_date, zoom, chart_style):
+    df = chart_frame(data.current().global_rollups, granularity, start_date, end_date, zoom, chart_style)
+    return series_chart(df, selected_barchart, 'Deaths', dths, chart_style,
+                        revision='{}/{}/{}'.format(granularity, start_date, end_date),
+                        marker_line_color='rgba(0,0,0,0)', marker_line_width=0.05)
+
+
+@app.callback(
+    Output(component_id='deaths_zoom', component_property='data'),
+    [Input(component_id='deaths_barchart', component_property='relayoutData'),
+     Input(component_id='deaths_granularity_selector', component_property='value'),
+     Input(component_id='chart_date_range', component_property='start_date'),
+     Input(component_id='chart_date_range', component_property='end_date')],
+    [State(component_id='deaths_zoom', component_property='data')]
+)
+@metrics.timed
+def update_deaths_zoom(relayout_data, granularity, start_date, end_date, zoom):
+    return next_zoom(relayout_data or {}, zoom)
+
+
 @app.callback(
     Output(component_id='deaths_barchart', component_property='figure'),
-    [Input(component_id='weekly_vs_cumulative_deaths_selector', component_property='value')]
+    [Input(component_id='weekly_vs_cumulative_deaths_selector', component_property='value'),
+     Input(component_id='deaths_granularity_selector', component_property='value'),
+     Input(component_id='chart_date_range', component_property='start_date'),
+     Input(component_id='chart_date_range', component_property='end_date'),
+     Input(component_id='deaths_zoom', component_property='data'),
+     Input(component_id='chart_style_selector', component_property='value')]
 )
-def update_deaths_barchart(selected_barchart):
+@metrics.timed
+def update_deaths_barchart(selected_barchart, granularity, start_date, end_date, zoom, chart_style):
     # print(selected_barchart)
+    return deaths_figure(selected_barchart, granularity, start_date, end_date, zoom, chart_style)
 
-    deaths_barchart = px.bar(global_df_weekly
-                             , x='Date'
-                             , y=selected_barchart
-                             , opacity=0.9
-                             , orientation='v'
-                             , barmode='relative'
-                             # , title='Global COVID19 {}'.format(selected_barchart)
-                             , hover_data=['Date', selected_barchart]
-                             , template='plotly_dark'
-                             , labels={'Date': 'Date',
-                                       selected_barchart: 'Deaths'})
-
-    deaths_barchart.update_layout({'font': {'family': 'arial', 'size': 12},
-                                   'plot_bgcolor': 'rgba(0,0,0,0)',
-                                   'paper_bgcolor': 'rgba(0,0,0,0)'
-                                   }
-                                  )
-    deaths_barchart.update_yaxes(showgrid=False, tickfont={'family': 'arial', 'size': 12}, linecolor='white')
-    deaths_barchart.update_xaxes(showgrid=False, tickfont={'family': 'arial', 'size': 12}, linecolor='white')
-    deaths_barchart.update_traces(marker_color=dths, marker_line_color='rgba(0,0,0,0)', marker_line_width=0.05)
-
-    return deaths_barchart
-
-# datatable and choropleth map
+# data card of the countries matching the table filter, from the snapshot's precomputed sums
 @app.callback(
-    Output(component_id='choropleth_map', component_property='figure'),
-    [Input(component_id='interactive_datable', component_property='derived_virtual_data'),
-     Input(component_id='interactive_datable', component_property='derived_virtual_selected_rows'),
-     Input(component_id='interactive_datable', component_property='selected_columns')],
+    Output('summary_stats_container', 'children'),
+    Input('interactive_datable', 'filter_query'),
+    prevent_initial_call=True
 )
-def update_choropleth(all_rows_data, slctd_rows_indices, selected_columns):
-    # print('Data across all pages pre or post filtering: {}'.format(all_rows_data))
-    # print('---------------------')
-    # print('Indices of selected rows if part of table after filtering: {}'.format(slctd_rows_indices))
-    # if len(slctd_rows_indices) > 0:
-    #   for i in slctd_rows_indices:
-    #       print('selected country after filtering: {}'.format(all_rows_data[i]['Country']))
-    # # print('selected country after filtering: {}'.format(all_rows_data[slctd_rows_indices[0]]['Country']))
-    # print('selected columns: {}'.format(selected_columns))
-    dff = pd.DataFrame(all_rows_data)
-
-    border_width = [3 if i in slctd_rows_indices else 1 for i in range(len(dff))]
-    border_color = ['white' if i in slctd_rows_indices else '#444' for i in range(len(dff))]
-    if len(selected_columns) == 0:
-        selected_column = 'Confirmed cases'
-    else:
-        selected_column = selected_columns[0]
+@metrics.timed
+def update_summary_card(filter_query):
+    filtered = bool((filter_query or '').strip())
+    return make_data_card(*data.current().summary(filter_query), filtered=filtered)
 
-     # is there a way to get the name of the headers, or columns?
-
-    figure = px.choropleth(
-        data_frame=dff,
-        locations='Country',
-        locationmode='country names',
-        color=selected_column,
-        title=selected_column,
-        color_continuous_scale='jet',
-        template='plotly_dark',
-        hover_data=['Country', 'Confirmed cases', 'Deaths']
-    )
-    figure.update_traces(marker_line_width=border_width, marker_line_color=border_color,)
-    figure.update_layout({'font': {'family': 'arial', 'size': 12},
+
+# datatable and choropleth map
+@figure_cache.memoize
+def choropleth_figure(filter_query, selected_column, resolution):
+    snapshot = data.current()
+    positions, _ = snapshot.map_rows(filter_query)
+
+    def column(name):
+        # plain arrays taken from the server side table, no per request DataFrame
+        return snapshot.table_engine.df[name].to_numpy()[positions]
+
+    # outlines come from a bundled geojson file the browser fetches once and caches (its url carries a
+    # fingerprint of the file), so the figure itself only carries iso3 codes and values
+    figure = go.Figure(go.Choropleth(
+        geojson=compression.asset_url(app, geometry.asset_path(resolution or geometry.DEFAULT_RESOLUTION)),
+        locations=column('iso3'),
+        z=column(selected_column),
+        coloraxis='coloraxis',
+        customdata=np.column_stack([column('Country'), column('Confirmed cases'), column('Deaths')]),
+        hovertemplate='Country=%{customdata[0]}<br>Confirmed cases=%{customdata[1]}<br>'
+                      'Deaths=%{customdata[2]}<br>' + selected_column + '=%{z}<extra></extra>',
+        marker_line_width=1,
+        marker_line_color='#444',
+    ))
+    figure.update_layout({'template': 'plotly_dark',
+                          'title': selected_column,
+                          'coloraxis': {'colorscale': 'jet', 'colorbar': {'title': selected_column}},
+                          'font': {'family': 'arial', 'size': 12},
                           'plot_bgcolor': '#060606',
                           'paper_bgcolor': '#060606',
                           'margin': {"r": 0, "t": 0, "l": 0, "b": 0},
                           'title_x': 0.45,
                           'title_y': 0.95,
+                          # keep the user's zoom and pan when the figure is replaced
+                          'uirevision': 'choropleth_map',
                             }
                          )
     figure.update_geos(showocean=True, oceancolor="#060606",projection_type="natural earth",bgcolor='#060606'
@@ -443,16 +584,126 @@ def update_choropleth(all_rows_data, slctd_rows_indices, selected_columns):
     return figure
 
 
+def selection_borders(trace_index, selected_countries):
+    """Border widths and colours of the map trace, highlighting the selected countries."""
+    border_width = np.ones(len(trace_index), dtype=int)
+    border_color = np.full(len(trace_index), '#444', dtype=object)
+    selected = [trace_index[country] for country in selected_countries or [] if country in trace_index]
+    border_width[selected] = 3
+    border_color[selected] = 'white'
+    return border_width.tolist(), border_color.tolist()
+
+
+@app.callback(
+    Output(component_id='choropleth_map', component_property='figure'),
+    [Input(component_id='interactive_datable', component_property='filter_query'),
+     Input(component_id='selected_countries', component_property='data'),
+     Input(component_id='interactive_datable', component_property='selected_columns'),
+     Input(component_id='map_resolution', component_property='data')],
+)
+@metrics.timed
+def update_choropleth(filter_query, selected_countries, selected_columns, resolution):
+    if len(selected_columns) == 0:
+        selected_column = 'Confirmed cases'
+    else:
+        selected_column = selected_columns[0]
+
+    _, trace_index = data.current().map_rows(filter_query)
+    if set(ctx.triggered_prop_ids) == {'selected_countries.data'}:
+        # only the selection changed: send the new border styles instead of the whole figure
+        figure = Patch()
+    else:
+        figure = choropleth_figure(filter_query, selected_column, resolution)
+    border_width, border_color = selection_borders(trace_index, selected_countries)
+    figure['data'][0]['marker']['line']['width'] = border_width
+    figure['data'][0]['marker']['line']['color'] = border_color
+    return figure
+
+
+@app.callback(
+    Output(component_id='map_resolution', component_property='data'),
+    [Input(component_id='choropleth_map', component_property='relayoutData')],
+    [State(component_id='map_resolution', component_property='data')]
+)
+@metrics.timed
+def update_map_resolution(relayout_data, resolution):
+    # only a zoom that crosses into another resolution redraws the map
+    if not relayout_data or 'geo.projection.scale' not in relayout_data:
+        raise PreventUpdate
+    new_resolution = geometry.resolution_for_scale(relayout_data['geo.projection.scale'])
+    if new_resolution == resolution:
+        raise PreventUpdate
+    return new_resolution
+
+
 '''
 need to work on styling of choropleth...
 Add title (use label from datatable), remove title from legend (increase graphs size?)
 '''
 
 
+@app.callback(
+    [Output('interactive_datable', 'data'),
+     Output('interactive_datable', 'page_count'),
+     Output('interactive_datable', 'page_current'),
+     Output('interactive_datable', 'selected_rows'),
+     Output('table_page', 'data')],
+    [Input('interactive_datable', 'page_current'),
+     Input('interactive_datable', 'page_size'),
+     Input('interactive_datable', 'sort_by'),
+     Input('interactive_datable', 'filter_query')],
+    [State('selected_countries', 'data')]
+)
+@metrics.timed
+def update_table_page(page_current, page_size, sort_by, filter_query, selected_countries):
+    table_engine = data.current().table_engine
+    triggered = set(ctx.triggered_prop_ids)
+    if triggered and not triggered & {'interactive_datable.page_current', 'interactive_datable.page_size'}:
+        # a new filter or sort starts from its first page
+        page_current = 0
+    records, page_count = table_engine.page(page_current, page_size, filter_query, sort_by)
+    if page_current and page_current >= page_count:
+        # e.g. a page of a longer table, before the data was refreshed
+        page_current = page_count - 1
+        records, page_count = table_engine.page(page_current, page_size, filter_query, sort_by)
+    # in custom paging the table keeps selected_rows as positions in the current page, so they are
+    # recomputed from the selected countries for every page
+    selected = set(selected_countries or [])
+    selected_rows = [i for i, record in enumerate(records) if record['id'] in selected]
+    table_page = {'page': [page_current, page_size, filter_query, sort_by],
+                  'ids': [record['id'] for record in records]}
+    return records, page_count, page_current, selected_rows, table_page
+
+
+@app.callback(
+    Output('selected_countries', 'data'),
+    [Input('interactive_datable', 'selected_row_ids')],
+    [State('interactive_datable', 'page_current'),
+     State('interactive_datable', 'page_size'),
+     State('interactive_datable', 'filter_query'),
+     State('interactive_datable', 'sort_by'),
+     State('table_page', 'data'),
+     State('selected_countries', 'data')]
+)
+@metrics.timed
+def update_selected_countries(selected_row_ids, page_current, page_size, filter_query, sort_by, table_page,
+                              selected_countries):
+    # The table clears its selection itself whenever its page, filter or sort changes, before the new page
+    # arrives. Only a click on the page it shows changes the selection.
+    if table_page is None or table_page['page'] != [page_current, page_size, filter_query, sort_by]:
+        raise PreventUpdate
+    # a click reports the selected rows of the current page only; selections on other pages are kept
+    page_ids = set(table_page['ids'])
+    clicked = [country for country in selected_row_ids or [] if country in page_ids]
+    selected = [country for country in selected_countries or [] if country not in page_ids or country in clicked]
+    return selected + [country for country in clicked if country not in selected]
+
+
 @app.callback(
     Output('interactive_datable', 'style_data_conditional'),
     [Input('interactive_datable', 'selected_columns')]
 )
+@metrics.timed
 def update_table_styles(selected_columns):
     # print('Selected columns: {}'.format(selected_columns))
 
@@ -465,6 +716,21 @@ def update_table_styles(selected_columns):
     ]
 
 
+# timings of the callbacks above and of every request, served on /metrics (see metrics.py)
+metrics.instrument_app(app)
+metrics.REGISTRY.gauge('covid_dashboard_figure_cache', 'Figure cache statistics.',
+                       lambda: [({'stat': stat}, value) for stat, value in figure_cache.stats().items()])
+metrics.REGISTRY.gauge('covid_dashboard_response_cache', 'Compressed response cache statistics.',
+                       lambda: [({'stat': stat}, value) for stat, value in response_cache.stats().items()])
+
+
+def data_age():
+    snapshot = data.current()
+    return [({'version': snapshot.version}, (datetime.now() - snapshot.loaded_at).total_seconds())]
+
+
+metrics.REGISTRY.gauge('covid_dashboard_data_age_seconds', 'Seconds since the current data snapshot was loaded.',
+                       data_age)
 
 # --------------------------------------------------------------------------------------------------------------
 if __name__ == '__main__':
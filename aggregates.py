@@ -0,0 +1,151 @@
+"""
+Daily, weekly and monthly rollups for the cases and deaths bar charts.
+
+Daily values are laid out once as (series x days) arrays on a continuous day axis, one row per country (or a
+single row for the global totals). Cumulative counts are forward filled, so a period's value is the one on its
+last day, and new cases/deaths are stored as prefix sums, so the total over any range of days is the difference
+of two entries. Any granularity and date range is then answered without a groupby, in time proportional to the
+number of bars drawn.
+"""
+import numpy as np
+import pandas as pd
+
+MEASURES = ['Confirmed', 'Deaths', 'New_cases', 'New_deaths']
+# cumulative counts take the value at the end of the period, new cases/deaths are summed over the period
+CUMULATIVE = ['Confirmed', 'Deaths']
+NEW = ['New_cases', 'New_deaths']
+
+# granularity -> (label, function giving the label of the period containing each date, as pd.Grouper does)
+GRANULARITIES = {
+    'daily': ('Daily', lambda dates: dates),
+    # weeks end on sunday, as pd.Grouper(freq='W')
+    'weekly': ('Weekly', lambda dates: dates + pd.to_timedelta(6 - dates.weekday, unit='D')),
+    'monthly': ('Monthly', lambda dates: dates + pd.offsets.MonthEnd(0)),
+}
+DEFAULT_GRANULARITY = 'weekly'
+
+
+def _period_starts(dates, granularity):
+    """Positions in dates of the first day of each period."""
+    if granularity == 'daily':
+        return np.arange(len(dates))
+    first = np.asarray(dates.weekday == 0 if granularity == 'weekly' else dates.day == 1)
+    if len(first):
+        first[0] = True
+    return np.flatnonzero(first)
+
+
+def _ffill(values, initial):
+    """values (series x days) with NaNs replaced by the last value before them in the row, or by initial."""
+    index = np.where(np.isnan(values), -1, np.arange(values.shape[1]))
+    np.maximum.accumulate(index, axis=1, out=index)
+    filled = np.take_along_axis(values, np.maximum(index, 0), axis=1)
+    return np.where(index >= 0, filled, initial[:, None])
+
+
+class Rollups:
+    """
+    MEASURES of every series (country) in a daily frame, answered at any granularity over any date range.
+    With key_column=None the frame holds a single series, such as daily_total_df.
+    """
+
+    def __init__(self, daily_df, key_column='Country_Region'):
+        self.key_column = key_column
+        self.keys = []
+        self.rows = {}
+        self.dates = pd.DatetimeIndex([])
+        self.values = {measure: np.zeros((0, 0)) for measure in CUMULATIVE}
+        # one more column than days: prefix[:, i] is the total of the days before i
+        self.prefix = {measure: np.zeros((0, 1)) for measure in NEW}
+        self._starts = {granularity: np.zeros(0, dtype=np.intp) for granularity in GRANULARITIES}
+        self._extend(daily_df)
+
+    def _extend(self, daily_df):
+        """Add the days of daily_df after the last day already held, keeping earlier days as they are."""
+        df = daily_df[daily_df['Date'] > self.dates[-1]] if len(self.dates) else daily_df
+        if self.key_column is None:
+            keys = pd.Series(0, index=df.index)
+            new_keys = [] if self.keys else [None]
+        else:
+            keys = df[self.key_column].astype(object)
+            new_keys = [key for key in pd.unique(keys.dropna()) if key not in self.rows]
+        self.keys = self.keys + new_keys
+        self.rows = {key: i for i, key in enumerate(self.keys)}
+        # series first seen in df have no earlier totals
+        padding = ((0, len(new_keys)), (0, 0))
+        values = {measure: np.pad(self.values[measure], padding) for measure in CUMULATIVE}
+        prefix = {measure: np.pad(self.prefix[measure], padding) for measure in NEW}
+        self.values, self.prefix = values, prefix
+        if len(df) == 0:
+            return
+
+        start = self.dates[-1] + pd.Timedelta(days=1) if len(self.dates) else df['Date'].min()
+        dates = pd.date_range(start, df['Date'].max(), freq='D')
+        day = ((df['Date'].to_numpy() - dates[0].to_datetime64()) // np.timedelta64(1, 'D')).astype(np.intp)
+        row = (np.zeros(len(df), dtype=np.intp) if self.key_column is None
+               else pd.Categorical(keys, categories=self.keys).codes.astype(np.intp))
+        known = row >= 0
+        day, row = day[known], row[known]
+        shape = (len(self.keys), len(dates))
+        for measure in CUMULATIVE:
+            daily = np.full(shape, np.nan)
+            daily[row, day] = df[measure].to_numpy(dtype=np.float64)[known]
+            # a series without a row for a day keeps its running total
+            last = values[measure][:, -1] if values[measure].shape[1] else np.zeros(shape[0])
+            self.values[measure] = np.hstack([values[measure], _ffill(daily, last)])
+        for measure in NEW:
+            daily = np.zeros(shape)
+            np.add.at(daily, (row, day), np.nan_to_num(df[measure].to_numpy(dtype=np.float64)[known]))
+            self.prefix[measure] = np.hstack([prefix[measure], prefix[measure][:, -1:] + daily.cumsum(axis=1)])
+        self.dates = self.dates.append(dates)
+        self._starts = {granularity: _period_starts(self.dates, granularity) for granularity in GRANULARITIES}
+
+    def appended(self, daily_df):
+        """A new Rollups with the days of daily_df after the last day held here added; self is not modified."""
+        rollups = Rollups.__new__(Rollups)
+        rollups.__dict__.update(self.__dict__)
+        rollups._extend(daily_df)
+        return rollups
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    @property
+    def first_date(self):
+        return self.dates[0] if len(self.dates) else None
+
+    @property
+    def last_date(self):
+        return self.dates[-1] if len(self.dates) else None
+
+    def frame(self, granularity=DEFAULT_GRANULARITY, start=None, end=None, keys=None, max_points=None):
+        """
+        MEASURES per period between start and end (inclusive, the whole range if None), summed over the series
+        in keys (every series if None). Periods cut by start or end only cover the days within the range.
+        Rows are labelled with the last day of their period.
+
+        With more than max_points periods in the range, consecutive periods are merged into at most max_points
+        rows: cumulative counts are taken at the end of the merged periods and new counts are their average per
+        period, so the values keep the scale of the granularity.
+        """
+        i = 0 if start is None else int(self.dates.searchsorted(pd.Timestamp(start).normalize()))
+        j = len(self.dates) if end is None else int(self.dates.searchsorted(pd.Timestamp(end).normalize(), 'right'))
+        rows = (np.arange(len(self.keys)) if keys is None
+                else np.array([self.rows[key] for key in keys if key in self.rows], dtype=np.intp))
+        if i >= j:
+            return pd.DataFrame({'Date': pd.DatetimeIndex([]), **{measure: [] for measure in MEASURES}})
+        starts = self._starts[granularity]
+        inner = starts[starts.searchsorted(i, 'right'):starts.searchsorted(j, 'left')]
+        bounds = np.concatenate([[i], inner, [j]])
+        periods = np.ones(len(bounds) - 1)
+        if max_points and len(bounds) - 1 > max_points:
+            step = -(-(len(bounds) - 1) // max_points)
+            merged = np.append(np.arange(0, len(bounds) - 1, step), len(bounds) - 1)
+            bounds, periods = bounds[merged], np.diff(merged)
+        data = {'Date': GRANULARITIES[granularity][1](self.dates[bounds[1:] - 1])}
+        for measure in CUMULATIVE:
+            data[measure] = self.values[measure][np.ix_(rows, bounds[1:] - 1)].sum(axis=0)
+        for measure in NEW:
+            prefix = self.prefix[measure][np.ix_(rows, bounds)].sum(axis=0)
+            data[measure] = np.diff(prefix) / periods
+        return pd.DataFrame(data)
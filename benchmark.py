@@ -0,0 +1,523 @@
+"""
+Benchmarks of the dashboard's data loading, callbacks and server, run offline against the bundled csv files.
+
+* load: building the column cache from the csv files, loading it back and deriving the frames and snapshot.
+* callbacks: each callback called directly, with p50/p95/p99 latency, memory allocated per call and the
+  size of the JSON payload dash would send. Memoized figures are timed both cold (cache cleared before
+  every call) and warm.
+* load_test: simulated browsers replaying interaction traces (radio toggles, granularities, date ranges,
+  chart styles and zooms, row and column selections, filter queries, sorting, paging, map zooms) against the Flask server, each firing the callbacks that
+  depend on the changed property, as the dash renderer does.
+
+Results are written as JSON; passing a previous result as --baseline reports (and exits non-zero on)
+regressions of latency, allocations or payload size beyond --tolerance.
+
+    python benchmark.py                                # writes benchmark_results.json
+    python benchmark.py --baseline baseline.json       # compare with an earlier run
+    python benchmark.py --clients 32 --duration 60 --url http://127.0.0.1:8050  # load test a running server
+
+The data is ingested into a temporary cache (the user's cache and ingest store are not touched), so results
+only depend on the bundled files. country_daily.csv is not bundled; pass it with --country-daily for the
+country selection benchmarks to use per country series.
+"""
+import argparse
+import contextvars
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+# filter queries typed in the datatable by the simulated users
+FILTER_QUERIES = [
+    '',
+    '{Continent} = Europe',
+    '{Confirmed cases} > 1000000',
+    '{Fatality rate} >= 2 && {Continent} = Africa',
+    '{Country} contains "land"',
+]
+SORT_COLUMNS = ['Confirmed cases', 'Deaths', 'Fatality rate', 'Cases/1 million population', '28 day cases']
+MAP_SCALES = [1, 1.5, 3, 4, 8]
+GRANULARITIES = ['daily', 'weekly', 'monthly']
+
+
+def percentiles(samples):
+    """Summary in milliseconds of a list of durations in seconds."""
+    ms = np.asarray(samples) * 1000
+    return {'n': len(ms),
+            'mean_ms': round(float(ms.mean()), 3),
+            'p50_ms': round(float(np.percentile(ms, 50)), 3),
+            'p95_ms': round(float(np.percentile(ms, 95)), 3),
+            'p99_ms': round(float(np.percentile(ms, 99)), 3),
+            'max_ms': round(float(ms.max()), 3)}
+
+
+def payload_bytes(value):
+    """Size of value serialized the way dash serializes callback outputs."""
+    import plotly.io.json
+
+    if hasattr(value, 'to_plotly_json'):
+        value = value.to_plotly_json()
+    return len(plotly.io.json.to_json_plotly(value))
+
+
+def measure(func, repeat, setup=None, warmup=2, allocation_repeat=5, payload=True):
+    """Latency percentiles, allocated bytes (peak, median over a few calls) and, if `payload`, the size of func()'s result."""
+    for _ in range(warmup):
+        setup and setup()
+        func()
+    durations = []
+    for _ in range(repeat):
+        setup and setup()
+        start = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - start)
+    # traced separately, tracemalloc slows every allocation down
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(allocation_repeat):
+            setup and setup()
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            func()
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    stats = percentiles(durations)
+    stats['alloc_peak_bytes'] = int(np.median(peaks))
+    if payload:
+        stats['payload_bytes'] = payload_bytes(result)
+    return stats
+
+
+def in_callback_context(func, triggered):
+    """func run with a dash callback context whose triggered inputs are the prop ids in `triggered`."""
+    from dash._callback_context import context_value
+    from dash._utils import AttributeDict
+
+    context = contextvars.copy_context()
+    context.run(context_value.set,
+                AttributeDict(triggered_inputs=[{'prop_id': prop_id, 'value': None} for prop_id in triggered]))
+    return lambda: context.run(func)
+
+
+# --------------------------------------------------------------------------------------------------------------
+
+def prepare_cache(cache_dir, country_daily=None):
+    """Ingest the bundled csv files (and country_daily if given) into cache_dir, before the app is imported."""
+    os.environ['COVID_DASHBOARD_CACHE_DIR'] = cache_dir
+    os.environ['COVID_DASHBOARD_OFFLINE'] = '1'
+    os.environ['COVID_DASHBOARD_REFRESH_INTERVAL'] = '0'
+    import data_store
+
+    if country_daily:
+        data_store.ingest_csv('country_daily', country_daily, cache_dir=cache_dir)
+    data_store.load_frames(offline=True, cache_dir=cache_dir)
+
+
+def benchmark_load(repeat, country_daily=None):
+    import aggregates
+    import data_store
+    import ingest
+    from snapshot import DataSnapshot
+
+    def cold():
+        # a fresh cache directory: the csv files are parsed, typed and written as columns
+        cache_dir = tempfile.mkdtemp(prefix='covid-bench-')
+        try:
+            if country_daily:
+                data_store.ingest_csv('country_daily', country_daily, cache_dir=cache_dir)
+            return data_store.load_frames(offline=True, cache_dir=cache_dir)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def warm():
+        return data_store.load_frames(offline=True)
+
+    loaded = warm()
+    frames = ingest.DailyFrames(*loaded)
+    # frames are not sent to the browser, there is no payload to measure
+    return {
+        'load_frames_cold': measure(cold, max(1, repeat // 10), warmup=0, allocation_repeat=1, payload=False),
+        'load_frames_warm': measure(warm, repeat, payload=False),
+        'daily_frames': measure(lambda: ingest.DailyFrames(*loaded), repeat, payload=False),
+        'global_rollups': measure(lambda: aggregates.Rollups(frames.daily_total_df, key_column=None), repeat,
+                                  payload=False),
+        'country_rollups': measure(lambda: aggregates.Rollups(frames.country_daily_df), repeat, payload=False),
+        'snapshot': measure(lambda: DataSnapshot.from_frames(frames), repeat, payload=False),
+    }
+
+
+def callback_cases(dashboard):
+    """(name, function, setup) of every benchmarked callback call."""
+    snapshot = dashboard.data.current()
+    top = snapshot.country_bar_df.sort_values('Confirmed cases', ascending=False)['Country'].astype(str)
+    selected = list(top[:3])
+    # the last 90 days
+    end = snapshot.global_rollups.last_date
+    start = end - pd.Timedelta(days=90)
+    cold = dashboard.figure_cache.clear
+
+    def cases(*args):
+        return lambda: dashboard.update_cases_barchart(*args)
+
+    def choropleth(triggered, *args):
+        return in_callback_context(lambda: dashboard.update_choropleth(*args), triggered)
+
+    return [
+        ('update_cases_barchart[global]', cases('New_cases', 'weekly', None, None, None, 'bar', []), None),
+        ('update_cases_barchart[global_cumulative]',
+         cases('Confirmed', 'weekly', None, None, None, 'bar', []), None),
+        ('update_cases_barchart[global_daily]', cases('New_cases', 'daily', None, None, None, 'bar', []), None),
+        ('update_cases_barchart[global_daily_webgl]',
+         cases('New_cases', 'daily', None, None, None, 'webgl', []), None),
+        ('update_cases_barchart[global_monthly]', cases('New_cases', 'monthly', None, None, None, 'bar', []), None),
+        ('update_cases_barchart[global_90_days]', cases('New_cases', 'daily', start, end, None, 'bar', []), None),
+        ('update_cases_barchart[3_countries]', cases('New_cases', 'weekly', None, None, None, 'bar', selected), None),
+        ('update_deaths_barchart[cold]',
+         lambda: dashboard.update_deaths_barchart('New_deaths', 'weekly', None, None, None, 'bar'), cold),
+        ('update_deaths_barchart[warm]',
+         lambda: dashboard.update_deaths_barchart('New_deaths', 'weekly', None, None, None, 'bar'), None),
+        ('update_choropleth[cold]',
+         choropleth(['interactive_datable.filter_query'], '', [], [], 'low'), cold),
+        ('update_choropleth[warm]',
+         choropleth(['interactive_datable.filter_query'], '', [], [], 'low'), None),
+        ('update_choropleth[filtered_cold]',
+         choropleth(['interactive_datable.filter_query'], '{Continent} = Europe', [], ['Deaths'], 'low'), cold),
+        ('update_choropleth[high_resolution_cold]',
+         choropleth(['map_resolution.data'], '', [], [], 'high'), cold),
+        ('update_choropleth[selection_patch]',
+         choropleth(['selected_countries.data'], '', selected, [], 'low'), None),
+        ('update_table_page[sorted_filtered]',
+         in_callback_context(lambda: dashboard.update_table_page(
+             0, 10, [{'column_id': 'Confirmed cases', 'direction': 'desc'}], '{Continent} = Europe', selected),
+             ['interactive_datable.filter_query']), None),
+        ('update_table_styles', lambda: dashboard.update_table_styles(['Confirmed cases']), None),
+        ('update_summary_card[global]', lambda: dashboard.update_summary_card(''), None),
+        ('update_summary_card[filtered]', lambda: dashboard.update_summary_card('{Continent} = Europe'), None),
+    ]
+
+
+def benchmark_callbacks(dashboard, repeat):
+    return {name: measure(func, repeat, setup=setup) for name, func, setup in callback_cases(dashboard)}
+
+
+# --------------------------------------------------------------------------------------------------------------
+
+def _outputs(output):
+    """The outputs field of a callback request for a callback_map key."""
+    if output.startswith('..'):
+        return [_prop(part) for part in output[2:-2].split('...')]
+    return _prop(output)
+
+
+def _prop(prop_id):
+    component_id, prop = prop_id.rsplit('.', 1)
+    return {'id': component_id, 'property': prop}
+
+
+def _wire_bytes(response):
+    # the body as sent, compressed when the server compressed it (requests decodes response.content)
+    return int(response.headers.get('Content-Length', len(response.content)))
+
+
+class Browser:
+    """A simulated dashboard page: the component properties callbacks read, and the callbacks they trigger."""
+
+    def __init__(self, session, url, callback_map, initial_state, last_date, seed):
+        self.session = session
+        self.url = url
+        self.callback_map = callback_map
+        self.state = dict(initial_state)
+        self.last_date = last_date
+        self.random = random.Random(seed)
+        self.samples = {}
+        self.bytes = {}
+        self.errors = 0
+
+    def _record(self, name, seconds, size):
+        self.samples.setdefault(name, []).append(seconds)
+        self.bytes.setdefault(name, []).append(size)
+
+    def open(self):
+        for path in ('/', '/_dash-layout', '/_dash-dependencies'):
+            start = time.perf_counter()
+            response = self.session.get(self.url + path)
+            self._record('GET ' + path, time.perf_counter() - start, _wire_bytes(response))
+            self.errors += response.status_code != 200
+        # the renderer calls every callback once the page is laid out
+        for output in self.callback_map:
+            self.fire(output, [])
+
+    def fire(self, output, changed):
+        spec = self.callback_map[output]
+        body = {'output': output, 'outputs': _outputs(output), 'changedPropIds': changed,
+                'inputs': [dict(item, value=self.state.get('{id}.{property}'.format(**item)))
+                           for item in spec['inputs']],
+                'state': [dict(item, value=self.state.get('{id}.{property}'.format(**item)))
+                          for item in spec['state']]}
+        start = time.perf_counter()
+        response = self.session.post(self.url + '/_dash-update-component', json=body)
+        self._record(output.strip('.').replace('...', ','), time.perf_counter() - start, _wire_bytes(response))
+        if response.status_code == 204:
+            # PreventUpdate
+            return
+        if response.status_code != 200:
+            self.errors += 1
+            return
+        updated = []
+        for component_id, props in response.json()['response'].items():
+            for prop, value in props.items():
+                prop_id = '{}.{}'.format(component_id, prop)
+                if prop_id in self.state and self.state[prop_id] != value:
+                    self.state[prop_id] = value
+                    updated.append(prop_id)
+        if updated:
+            self.change({}, updated, source=output)
+
+    def change(self, values, changed=None, source=None):
+        """
+        Set component properties, as a user action does, and fire the callbacks that depend on them
+        (except source, the callback that set them: dash does not call a callback for its own outputs).
+        """
+        self.state.update(values)
+        changed = changed or list(values)
+        for output, spec in self.callback_map.items():
+            triggered = [prop_id for prop_id in changed
+                         if any('{id}.{property}'.format(**item) == prop_id for item in spec['inputs'])]
+            if triggered and output != source:
+                self.fire(output, triggered)
+
+    def act(self):
+        """One random user action."""
+        action = self.random.choice(['cases', 'deaths', 'granularity', 'date_range', 'chart_style', 'chart_zoom',
+                                     'select_row', 'select_column', 'filter', 'sort', 'page', 'zoom'])
+        if action == 'cases':
+            current = self.state['weekly_vs_cumulative_cases_selector.value']
+            self.change({'weekly_vs_cumulative_cases_selector.value':
+                         'Confirmed' if current == 'New_cases' else 'New_cases'})
+        elif action == 'deaths':
+            current = self.state['weekly_vs_cumulative_deaths_selector.value']
+            self.change({'weekly_vs_cumulative_deaths_selector.value':
+                         'Deaths' if current == 'New_deaths' else 'New_deaths'})
+        elif action == 'granularity':
+            selector = self.random.choice(['cases_granularity_selector', 'deaths_granularity_selector'])
+            self.change({selector + '.value': self.random.choice(GRANULARITIES)})
+        elif action == 'date_range':
+            days = self.random.choice([None, 30, 90, 365])
+            start = None if days is None else str((self.last_date - pd.Timedelta(days=days)).date())
+            self.change({'chart_date_range.start_date': start,
+                         'chart_date_range.end_date': None if days is None else str(self.last_date.date())})
+        elif action == 'chart_style':
+            self.change({'chart_style_selector.value': self.random.choice(['bar', 'webgl'])})
+        elif action == 'chart_zoom':
+            chart = self.random.choice(['confirmed_cases_barchart', 'deaths_barchart'])
+            days = self.random.choice([None, 60, 200])
+            relayout = ({'xaxis.autorange': True} if days is None else
+                        {'xaxis.range[0]': str((self.last_date - pd.Timedelta(days=days)).date()),
+                         'xaxis.range[1]': str(self.last_date.date())})
+            self.change({chart + '.relayoutData': relayout})
+        elif action == 'select_row':
+            # a click toggles a row of the current page; the table reports that page's selected rows
+            page_ids = (self.state['table_page.data'] or {}).get('ids') or []
+            if not page_ids:
+                return
+            checked = [c for c in self.state['selected_countries.data'] or [] if c in page_ids]
+            country = self.random.choice(page_ids)
+            checked = [c for c in checked if c != country] if country in checked else checked + [country]
+            self.change({'interactive_datable.selected_row_ids': checked})
+        elif action == 'select_column':
+            self.change({'interactive_datable.selected_columns': [self.random.choice(SORT_COLUMNS)]})
+        elif action == 'filter':
+            self.change({'interactive_datable.filter_query': self.random.choice(FILTER_QUERIES)})
+        elif action == 'sort':
+            self.change({'interactive_datable.sort_by': [{'column_id': self.random.choice(SORT_COLUMNS),
+                                                          'direction': self.random.choice(['asc', 'desc'])}]})
+        elif action == 'page':
+            self.change({'interactive_datable.page_current': self.random.randrange(5)})
+        else:
+            self.change({'choropleth_map.relayoutData': {'geo.projection.scale': self.random.choice(MAP_SCALES)}})
+
+
+def initial_state(app, callback_map):
+    """Initial values in the layout of every property used as a callback input or state."""
+    props = {'{id}.{property}'.format(**item)
+             for spec in callback_map.values() for item in spec['inputs'] + spec['state']}
+    layout = app.layout() if callable(app.layout) else app.layout
+    state = dict.fromkeys(props)
+    for component in [layout] + list(layout._traverse()):
+        component_id = getattr(component, 'id', None)
+        for prop_id in props:
+            if prop_id.rsplit('.', 1)[0] == component_id:
+                state[prop_id] = getattr(component, prop_id.rsplit('.', 1)[1], None)
+    return state
+
+
+def serve(app):
+    """Start app's Flask server on a free local port in a daemon thread and return its url."""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    server = make_server('127.0.0.1', 0, app.server, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name='benchmark-server', daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(server.server_port), server
+
+
+def load_test(dashboard, clients, duration, url=None, seed=0):
+    import requests
+
+    server = None
+    if url is None:
+        url, server = serve(dashboard.app)
+    callback_map = {output: {'inputs': spec['inputs'], 'state': spec['state']}
+                    for output, spec in dashboard.app.callback_map.items()}
+    state = initial_state(dashboard.app, callback_map)
+    last_date = dashboard.data.current().global_rollups.last_date
+    browsers = []
+    deadline = time.perf_counter() + duration
+
+    def run(index):
+        with requests.Session() as session:
+            browser = Browser(session, url, callback_map, state, last_date, seed + index)
+            browsers.append(browser)
+            browser.open()
+            while time.perf_counter() < deadline:
+                browser.act()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if server is not None:
+        server.shutdown()
+
+    results = {'clients': clients, 'duration_s': round(elapsed, 2), 'url': url if server is None else 'in-process',
+               'errors': sum(browser.errors for browser in browsers), 'requests': {}}
+    names = sorted({name for browser in browsers for name in browser.samples})
+    total = 0
+    for name in names:
+        samples = [s for browser in browsers for s in browser.samples.get(name, [])]
+        sizes = [s for browser in browsers for s in browser.bytes.get(name, [])]
+        stats = percentiles(samples)
+        stats['mean_bytes'] = int(np.mean(sizes))
+        results['requests'][name] = stats
+        total += len(samples)
+    results['requests_per_s'] = round(total / elapsed, 1)
+    return results
+
+
+# --------------------------------------------------------------------------------------------------------------
+
+# metrics compared with a baseline; higher is worse for all of them
+COMPARED = ['p50_ms', 'p95_ms', 'alloc_peak_bytes', 'payload_bytes', 'mean_bytes']
+# increases smaller than this are timer noise, whatever their ratio
+MIN_DELTA = {'p50_ms': 1, 'p95_ms': 1}
+
+
+def regressions(results, baseline, tolerance):
+    """(benchmark, metric, baseline value, value) of every metric more than `tolerance` worse than baseline."""
+    found = []
+    for section in ('load', 'callbacks'):
+        for name, stats in results.get(section, {}).items():
+            found += _compare('{}/{}'.format(section, name), stats, baseline.get(section, {}).get(name), tolerance)
+    for name, stats in results.get('load_test', {}).get('requests', {}).items():
+        previous = baseline.get('load_test', {}).get('requests', {}).get(name)
+        found += _compare('load_test/' + name, stats, previous, tolerance)
+    return found
+
+
+def _compare(name, stats, previous, tolerance):
+    if not previous:
+        return []
+    return [(name, metric, previous[metric], stats[metric]) for metric in COMPARED
+            if metric in stats and previous.get(metric) and stats[metric] > previous[metric] * (1 + tolerance)
+            and stats[metric] - previous[metric] > MIN_DELTA.get(metric, 0)]
+
+
+def environment(dashboard):
+    import dash
+    import plotly
+
+    frames = dashboard.data.current().frames
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'dash': dash.__version__, 'plotly': plotly.__version__, 'pandas': pd.__version__,
+            'numpy': np.__version__, 'data_version': dashboard.data.current().version,
+            'rows': {'country_daily': len(frames.country_daily_df),
+                     'country_latest': len(frames.country_latest_df),
+                     'daily_total': len(frames.daily_total_df)}}
+
+
+def print_table(title, rows):
+    print('\n' + title)
+    print('{:<60}{:>10}{:>10}{:>10}{:>14}{:>12}'.format('', 'p50 ms', 'p95 ms', 'p99 ms', 'alloc bytes', 'bytes'))
+    for name, stats in rows.items():
+        print('{:<60}{:>10.2f}{:>10.2f}{:>10.2f}{:>14,}{:>12,}'.format(
+            name, stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats.get('alloc_peak_bytes', 0),
+            stats.get('payload_bytes', stats.get('mean_bytes', 0))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=50, help='timed calls per load and callback benchmark')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent simulated browsers')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load test')
+    parser.add_argument('--url', help='load test a running server instead of one started in this process')
+    parser.add_argument('--country-daily', help='a country_daily.csv to ingest along with the bundled files')
+    parser.add_argument('--skip', action='append', default=[], choices=['load', 'callbacks', 'load_test'])
+    parser.add_argument('--out', default='benchmark_results.json')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative increase over the baseline')
+    args = parser.parse_args(argv)
+
+    cache_dir = tempfile.mkdtemp(prefix='covid-bench-')
+    try:
+        prepare_cache(cache_dir, args.country_daily)
+        import CovidDashboard as dashboard
+
+        results = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': environment(dashboard)}
+        if 'load' not in args.skip:
+            results['load'] = benchmark_load(args.repeat, args.country_daily)
+            print_table('load', results['load'])
+        if 'callbacks' not in args.skip:
+            results['callbacks'] = benchmark_callbacks(dashboard, args.repeat)
+            print_table('callbacks', results['callbacks'])
+        if 'load_test' not in args.skip:
+            results['load_test'] = load_test(dashboard, args.clients, args.duration, args.url)
+            print_table('load test: {clients} clients, {requests_per_s} requests/s, {errors} errors'.format(
+                **results['load_test']), results['load_test']['requests'])
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('\nresults written to', args.out)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.tolerance)
+        for name, metric, before, after in found:
+            print('REGRESSION {} {}: {} -> {}'.format(name, metric, before, after))
+        if found:
+            return 1
+        print('no regressions over {:.0%} against {}'.format(args.tolerance, args.baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+Compression and browser caching of the dashboard's responses.
+
+init_app() enables Flask-Compress on the dash app's server: callback responses, the layout, the index page,
+the component bundles and the geo outlines are sent brotli (or gzip) compressed when larger than
+COVID_DASHBOARD_COMPRESS_MIN_SIZE bytes. Compressed bodies are kept in a ResponseCache keyed on the request
+and the version of the loaded data, so a figure, layout or bundle served again is not compressed again.
+
+Browser caching:
+
+* dash component bundles are fingerprinted by dash itself (a version in the file name) and served with a
+  one year max-age.
+* files under assets/ requested through asset_url() carry a hash of their content and get a one year,
+  immutable max-age; other assets are revalidated with their ETag.
+* the layout and callback dependencies get a weak ETag and are revalidated on every load, so a repeat visit
+  with unchanged data gets 304 responses instead of the layout again.
+* the CYBORG theme is loaded from jsDelivr at a url pinned to the bootswatch version, which the CDN already
+  serves with a one year max-age.
+"""
+import functools
+import hashlib
+import mimetypes
+import os
+
+from figure_cache import FigureCache
+
+# smaller responses are sent as they are, compressing them saves less than the header overhead
+MIN_SIZE = int(os.environ.get('COVID_DASHBOARD_COMPRESS_MIN_SIZE', 1024))
+ALGORITHMS = ['br', 'gzip']
+MIMETYPES = ['text/html', 'text/css', 'text/javascript', 'application/javascript', 'application/json',
+             'application/geo+json']
+# compressed bodies are cached, so a higher brotli quality than Flask-Compress' default (4) costs little
+BROTLI_LEVEL = int(os.environ.get('COVID_DASHBOARD_BROTLI_LEVEL', 5))
+
+# for urls that change whenever their content does
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# cache key of responses that must not be cached (they do not only depend on the request and the data)
+UNCACHED = 'uncached'
+
+
+class ResponseCache(FigureCache):
+    """
+    LRU of compressed response bodies, bounded by count and bytes, with the get/set interface of a
+    Flask-Compress cache backend. set_version() drops the bodies built from older data.
+    """
+
+    def get(self, key):
+        return None if key.endswith(UNCACHED) else super().get(key)
+
+    def set(self, key, payload):
+        if not key.endswith(UNCACHED):
+            self.put(key, payload)
+
+
+def _dash_paths(app):
+    prefix = app.config.routes_pathname_prefix
+    assets = prefix + app.config.assets_url_path.strip('/') + '/'
+    return prefix, assets
+
+
+def _cacheable(app, path):
+    prefix, assets = _dash_paths(app)
+    # not the index page, newer dash versions render a token per page load into it
+    return path.startswith(assets) or path.startswith(prefix + '_dash-')
+
+
+def _cache_key(app, cache, request):
+    """Key of the compressed response to request: the same request on the same data gets the same response."""
+    if not _cacheable(app, request.path):
+        return UNCACHED
+    digest = hashlib.sha1()
+    # the encoding is part of the key, older Flask-Compress versions do not add it themselves
+    for part in (cache.version, request.method, request.full_path, request.headers.get('Accept-Encoding', '')):
+        digest.update('{}\0'.format(part).encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def _cache_headers(app, response):
+    import flask
+
+    request = flask.request
+    prefix, assets = _dash_paths(app)
+    if request.path.startswith(assets):
+        # asset_url() and dash's own asset links add a fingerprint of the file
+        if 'v' in request.args or 'm' in request.args:
+            response.headers['Cache-Control'] = IMMUTABLE
+        else:
+            response.cache_control.no_cache = True
+    elif (request.method in ('GET', 'HEAD') and response.status_code == 200
+          and request.path in (prefix + '_dash-layout', prefix + '_dash-dependencies')):
+        # weak: the compressed and plain bodies share the tag
+        response.cache_control.no_cache = True
+        response.add_etag(weak=True)
+        response.make_conditional(request)
+    return response
+
+
+def init_app(app, cache):
+    """Compress the responses of the dash app's server, caching compressed bodies in cache (a ResponseCache)."""
+    from flask_compress import Compress
+
+    # flask serves files with the type mimetypes guesses from their extension, which only knows .geojson on
+    # hosts whose /etc/mime.types lists it; anywhere else the outlines would go out uncompressed as octet-stream
+    mimetypes.add_type('application/geo+json', '.geojson')
+    server = app.server
+    server.config.update(
+        COMPRESS_MIMETYPES=MIMETYPES,
+        COMPRESS_ALGORITHM=ALGORITHMS,
+        COMPRESS_MIN_SIZE=MIN_SIZE,
+        COMPRESS_BR_LEVEL=BROTLI_LEVEL,
+        COMPRESS_CACHE_BACKEND=lambda: cache,
+        COMPRESS_CACHE_KEY=functools.partial(_cache_key, app, cache),
+    )
+    Compress(server)
+    # registered after Flask-Compress so it runs first, on the uncompressed body
+    server.after_request(functools.partial(_cache_headers, app))
+
+
+@functools.lru_cache(maxsize=None)
+def _fingerprint(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+
+def asset_url(app, path):
+    """app.get_asset_url(path) with a hash of the file's content, so browsers can cache it for good."""
+    return '{}?v={}'.format(app.get_asset_url(path), _fingerprint(os.path.join(app.config.assets_folder, path)))
@@ -0,0 +1,317 @@
+"""
+Local columnar cache for the dashboard's csv sources.
+
+Each csv is downloaded (or read from the bundled copy in offline mode) once,
+split into one .npy file per column and stored under CACHE_DIR.  Text columns
+are stored as integer codes plus a small array of categories so that every
+column can be memory mapped.  Workers then build their frames straight from
+the mapped arrays instead of parsing csv over the network.
+
+    python data_store.py            # refresh the cache from github (or COVID_DASHBOARD_DATA_URL)
+    python data_store.py --offline  # build the cache from the bundled csv files
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import fetch
+import metrics
+import schema
+
+logger = logging.getLogger(__name__)
+
+BASE_URL = os.environ.get('COVID_DASHBOARD_DATA_URL', 'https://github.com/dknight26275/Covid19Dashboard/raw/main/')
+BUNDLED_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.environ.get('COVID_DASHBOARD_CACHE_DIR', os.path.join(BUNDLED_DIR, '.data_cache'))
+# seconds a cached source is trusted before it is checked against github again
+CACHE_MAX_AGE = int(os.environ.get('COVID_DASHBOARD_CACHE_MAX_AGE', 6 * 60 * 60))
+OFFLINE = os.environ.get('COVID_DASHBOARD_OFFLINE', '').lower() in ('1', 'true', 'yes')
+
+SOURCES = ('country_daily', 'country_latest', 'daily_total')
+
+# columns used by the dashboard, for sources that may be neither bundled nor cached when offline
+EMPTY_COLUMNS = {
+    'country_daily': ['Date', 'Country_Region', 'Confirmed', 'Deaths', 'New_cases', 'New_deaths'],
+}
+
+MANIFEST = 'manifest.json'
+# bumped whenever the stored column layout or schema changes, so caches written before are re-ingested
+FORMAT_VERSION = 2
+
+
+# --------------------------------------------------------------------------------------------------------------
+# cache layout: CACHE_DIR/<name>/manifest.json points at CACHE_DIR/<name>/<version>/ which holds the columns.
+# A new version is written to its own directory and the manifest is replaced atomically, so a worker
+# starting up while another one ingests always sees a complete version.
+
+def _source_dir(name, cache_dir=None):
+    return os.path.join(cache_dir or CACHE_DIR, name)
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_manifest(name, cache_dir=None):
+    manifest = read_json(os.path.join(_source_dir(name, cache_dir), MANIFEST))
+    if manifest is None or not os.path.isdir(os.path.join(_source_dir(name, cache_dir), manifest.get('version', ''))):
+        return None
+    return manifest
+
+
+def write_json_atomic(path, obj):
+    """Write obj as json to path so that readers see either the old or the new file, never a partial one."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _write_manifest(name, manifest, cache_dir=None):
+    write_json_atomic(os.path.join(_source_dir(name, cache_dir), MANIFEST), manifest)
+
+
+def _remove_old_versions(name, keep, cache_dir=None):
+    # workers still holding a mapping of an old version keep their pages until they exit
+    source_dir = _source_dir(name, cache_dir)
+    for entry in os.listdir(source_dir):
+        path = os.path.join(source_dir, entry)
+        if entry != keep and os.path.isdir(path) and not entry.startswith('.'):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def sha256_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def ingest_csv(name, csv_path, sha256=None, cache_dir=None, **extra):
+    """
+    Parse csv_path once and store it as a new cache version of `name`. Returns the manifest.
+    Raises schema.SchemaError, leaving the cache as it was, if the csv is not a table of the source's schema.
+    """
+    sha256 = sha256 or sha256_file(csv_path)
+    manifest = read_manifest(name, cache_dir)
+    if is_current(manifest, sha256):
+        # content unchanged, only refresh the bookkeeping (fetch time, etag...)
+        manifest.update(extra, checked_at=time.time())
+        _write_manifest(name, manifest, cache_dir)
+        return manifest
+
+    with metrics.span('parse_csv', source=name):
+        try:
+            df = schema.apply(name, pd.read_csv(csv_path, index_col=0))
+        except ValueError as error:
+            # unparsable content (pandas' parser errors are ValueErrors) is not a new version of the source
+            raise schema.SchemaError('{} could not be parsed: {}'.format(name, error)) from error
+    # checked before anything is written, so a bad download never replaces the cached copy
+    schema.validate(name, df)
+    version = '{}-v{}'.format(sha256[:16], FORMAT_VERSION)
+    source_dir = _source_dir(name, cache_dir)
+    os.makedirs(source_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=source_dir, prefix='.ingest-')
+    with metrics.span('write_columns', source=name):
+        columns = write_columns(df, tmp_dir)
+
+    version_dir = os.path.join(source_dir, version)
+    if os.path.isdir(version_dir):
+        # another worker ingested the same content first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    else:
+        os.rename(tmp_dir, version_dir)
+
+    manifest = dict(extra, version=version, sha256=sha256, format=FORMAT_VERSION, rows=len(df), columns=columns,
+                    checked_at=time.time())
+    _write_manifest(name, manifest, cache_dir)
+    _remove_old_versions(name, keep=version, cache_dir=cache_dir)
+    return manifest
+
+
+def is_current(manifest, sha256):
+    """True if the cached version described by manifest holds the content with this checksum in the current format."""
+    return (manifest is not None and manifest['sha256'] == sha256
+            and manifest.get('format') == FORMAT_VERSION)
+
+
+def write_columns(df, directory):
+    """Save each column of df as .npy files in directory. Returns the column descriptions for read_columns."""
+    columns = []
+    for i, column in enumerate(df.columns):
+        values = df[column]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            np.save(os.path.join(directory, '{}.npy'.format(i)), values.to_numpy(dtype='datetime64[ns]'))
+            columns.append({'name': column, 'kind': 'datetime'})
+        elif not pd.api.types.is_numeric_dtype(values):
+            # text is stored as codes into its sorted distinct values, and read back as a categorical
+            categorical = pd.Categorical(values)
+            np.save(os.path.join(directory, '{}.npy'.format(i)), categorical.codes.astype(np.int32))
+            np.save(os.path.join(directory, '{}.categories.npy'.format(i)),
+                    categorical.categories.to_numpy(dtype=str))
+            columns.append({'name': column, 'kind': 'text'})
+        else:
+            np.save(os.path.join(directory, '{}.npy'.format(i)), values.to_numpy())
+            columns.append({'name': column, 'kind': 'numeric'})
+    return columns
+
+
+def read_columns(directory, columns, mmap=True):
+    """Build a DataFrame from columns saved by write_columns, memory mapping them by default."""
+    mmap_mode = 'r' if mmap else None
+    data = {}
+    for i, column in enumerate(columns):
+        values = np.load(os.path.join(directory, '{}.npy'.format(i)), mmap_mode=mmap_mode)
+        if column['kind'] == 'text':
+            categories = np.load(os.path.join(directory, '{}.categories.npy'.format(i)))
+            # codes of -1 (missing values) come back as NaN
+            values = pd.Categorical.from_codes(values, categories.astype(object))
+        data[column['name']] = values
+    return pd.DataFrame(data, copy=False)
+
+
+def load_cached(name, manifest=None, cache_dir=None, mmap=True):
+    """Build a DataFrame from the cached columns of `name`, memory mapping them by default."""
+    manifest = manifest or read_manifest(name, cache_dir)
+    if manifest is None:
+        raise FileNotFoundError('no cached copy of {}'.format(name))
+    version_dir = os.path.join(_source_dir(name, cache_dir), manifest['version'])
+    # a no-op for caches in the current format, which are stored already typed
+    return schema.apply(name, read_columns(version_dir, manifest['columns'], mmap=mmap))
+
+
+# --------------------------------------------------------------------------------------------------------------
+# refreshing the cache
+
+def source_url(name, base_url=None):
+    return (base_url or BASE_URL) + name + '.csv'
+
+
+def refresh(name, cache_dir=None, base_url=None):
+    """
+    Download `name` and ingest it if its checksum changed. The download is conditional on the ETag and
+    Last-Modified of the previous one, an unchanged source only has its check time updated. Returns the manifest.
+    """
+    url = source_url(name, base_url)
+    manifest = read_manifest(name, cache_dir)
+    # a cache in an older format is rebuilt, which needs the content even if it did not change
+    previous = (manifest if manifest is not None and manifest.get('format') == FORMAT_VERSION
+                and manifest.get('source') == url else {})
+    os.makedirs(_source_dir(name, cache_dir), exist_ok=True)
+    with metrics.span('download', source=name):
+        # streamed into the source's cache directory, next to the versions it is ingested into
+        fetched = fetch.fetch(url, dest_dir=_source_dir(name, cache_dir),
+                              etag=previous.get('etag'), last_modified=previous.get('last_modified'))
+    if fetched is None:
+        manifest.update(checked_at=time.time())
+        _write_manifest(name, manifest, cache_dir)
+        return manifest
+    path, sha256, headers = fetched
+    try:
+        return ingest_csv(name, path, sha256=sha256, cache_dir=cache_dir, source=url,
+                          etag=headers.get('ETag'), last_modified=headers.get('Last-Modified'))
+    finally:
+        os.remove(path)
+
+
+def _is_stale(manifest, max_age):
+    return (manifest is None or manifest.get('format') != FORMAT_VERSION
+            or time.time() - manifest.get('checked_at', 0) > max_age)
+
+
+def refresh_stale(names, cache_dir=None, max_age=None, base_url=None):
+    """
+    Manifests of the sources in names, refreshing those missing or checked more than max_age seconds ago
+    concurrently. A source whose refresh fails, or whose download is not a table of its schema, keeps its
+    cached copy (the error is logged); with no cached copy the error is raised.
+    """
+    max_age = CACHE_MAX_AGE if max_age is None else max_age
+    manifests = {name: read_manifest(name, cache_dir) for name in names}
+    stale = [name for name in names if _is_stale(manifests[name], max_age)]
+    if not stale:
+        return manifests
+    with ThreadPoolExecutor(max_workers=len(stale), thread_name_prefix='fetch') as pool:
+        futures = {name: pool.submit(refresh, name, cache_dir, base_url) for name in stale}
+    for name, future in futures.items():
+        try:
+            manifests[name] = future.result()
+        except (OSError, schema.SchemaError) as error:
+            if manifests[name] is None:
+                raise
+            logger.warning('refreshing %s failed (%s), using the cached copy', name, error)
+    return manifests
+
+
+def _bundled_path(name):
+    path = os.path.join(BUNDLED_DIR, name + '.csv')
+    return path if os.path.exists(path) else None
+
+
+def load_frame(name, offline=None, cache_dir=None, max_age=None):
+    """Return the DataFrame for source `name`, going to the network only when the cache is missing or stale."""
+    offline = OFFLINE if offline is None else offline
+    max_age = CACHE_MAX_AGE if max_age is None else max_age
+    manifest = read_manifest(name, cache_dir)
+
+    if offline:
+        bundled = _bundled_path(name)
+        if bundled is not None:
+            sha256 = sha256_file(bundled)
+            if not is_current(manifest, sha256):
+                manifest = ingest_csv(name, bundled, sha256=sha256, cache_dir=cache_dir, source=bundled)
+        elif manifest is None:
+            return schema.apply(name, pd.DataFrame(columns=EMPTY_COLUMNS.get(name, [])))
+        return load_cached(name, manifest, cache_dir)
+
+    manifest = refresh_stale([name], cache_dir=cache_dir, max_age=max_age)[name]
+    return load_cached(name, manifest, cache_dir)
+
+
+def data_version(cache_dir=None):
+    """Short identifier of the cached content of every source, changing whenever any source is re-ingested."""
+    manifests = [read_manifest(name, cache_dir) for name in SOURCES]
+    return '-'.join(manifest['version'][:8] if manifest else 'none' for manifest in manifests)
+
+
+def load_frames(offline=None, cache_dir=None):
+    """Load every source, returning (country_daily_df, country_latest_df, daily_total_df)."""
+    offline = OFFLINE if offline is None else offline
+    manifests = {}
+    if not offline:
+        # stale sources are downloaded in parallel up front. Their manifests are loaded as they are: a source
+        # whose download failed keeps its cached copy rather than being tried again
+        with metrics.span('refresh_sources'):
+            manifests = refresh_stale(SOURCES, cache_dir=cache_dir)
+    frames = []
+    for name in SOURCES:
+        with metrics.span('load_frame', source=name):
+            if offline:
+                frames.append(load_frame(name, offline=True, cache_dir=cache_dir))
+            else:
+                frames.append(load_cached(name, manifests[name], cache_dir))
+    return tuple(frames)
+
+
+if __name__ == '__main__':
+    if '--offline' in sys.argv[1:]:
+        for source in SOURCES:
+            load_frame(source, offline=True)
+            manifest = read_manifest(source)
+            print(source, manifest['version'] if manifest else 'not available offline')
+    else:
+        for source, manifest in refresh_stale(SOURCES, max_age=0).items():
+            print(source, manifest['version'])
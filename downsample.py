@@ -0,0 +1,55 @@
+"""
+Point budget of the time series charts.
+
+Bar charts are drawn as one SVG element per bar, so a daily view of the whole pandemic would send and render
+over a thousand bars per chart. Rollups.frame(max_points=MAX_POINTS) merges consecutive periods when a range
+holds more of them than the budget; the line (WebGL) view keeps the shape of the series with
+Largest-Triangle-Three-Buckets, which keeps the peaks a plain average would flatten. Either way a chart never
+carries more than MAX_POINTS points, however long the history.
+"""
+import os
+
+import numpy as np
+
+# points drawn per chart
+MAX_POINTS = int(os.environ.get('COVID_DASHBOARD_CHART_POINTS', 300))
+
+# chart style -> label
+CHART_STYLES = {
+    'bar': 'Bars',
+    'webgl': 'Line (WebGL)',
+}
+DEFAULT_CHART_STYLE = 'bar'
+
+
+def lttb(x, y, n_out):
+    """
+    Positions of the n_out points of the series (x, y) kept by Largest-Triangle-Three-Buckets: the first and
+    last points, and from each of n_out - 2 buckets the point forming the largest triangle with the point kept
+    from the previous bucket and the average of the next bucket.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+    keep = np.empty(n_out, dtype=np.intp)
+    keep[0], keep[-1] = 0, n - 1
+    previous = 0
+    for bucket in range(n_out - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        next_lo, next_hi = (edges[bucket + 1], edges[bucket + 2]) if bucket + 2 < len(edges) else (n - 1, n)
+        next_x, next_y = x[next_lo:next_hi].mean(), y[next_lo:next_hi].mean()
+        ax, ay = x[previous], y[previous]
+        # twice the triangle areas, enough to compare them
+        area = np.abs((ax - next_x) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (next_y - ay))
+        previous = lo + int(area.argmax())
+        keep[bucket + 1] = previous
+    return keep
+
+
+def lttb_frame(df, column, n_out=MAX_POINTS, x='Date'):
+    """The rows of df kept by lttb() for the series (df[x], df[column])."""
+    dates = df[x].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    return df.iloc[lttb(dates, df[column].to_numpy(), n_out)]
@@ -0,0 +1,185 @@
+"""
+HTTP downloads of the csv sources, with timeouts, retries and conditional requests.
+
+fetch() streams a url into a temporary file, hashing it on the way, so a source is never held in memory
+whole. Downloads of a process share one requests session, whose connection pool lets parallel and later
+downloads from the same host reuse their connections. Connection errors, timeouts and 429/5xx answers are
+retried with exponential backoff. Given the ETag and Last-Modified of the previous download, the request is
+conditional and an unchanged file costs a 304 instead of a download.
+
+The base url of the sources (COVID_DASHBOARD_DATA_URL) can point at a local stand-in for github, serving
+csv files from a directory with ETags and, to try out timeouts and retries, slowly or with failures:
+
+    python fetch.py --port 8000 --delay 0.5 --failures 2   # serves the bundled csv files
+    COVID_DASHBOARD_DATA_URL=http://localhost:8000/ python data_store.py
+"""
+import argparse
+import functools
+import hashlib
+import http.server
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# seconds to connect and between bytes received, not for the whole download
+TIMEOUT = float(os.environ.get('COVID_DASHBOARD_FETCH_TIMEOUT', 30))
+RETRIES = int(os.environ.get('COVID_DASHBOARD_FETCH_RETRIES', 3))
+# seconds before the first retry, doubled for every further one
+BACKOFF = float(os.environ.get('COVID_DASHBOARD_FETCH_BACKOFF', 1))
+RETRY_STATUS = {429, 500, 502, 503, 504}
+CHUNK_SIZE = 1 << 20
+# connections kept per host, at least one per source downloaded in parallel
+POOL_SIZE = 8
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _reset_session():
+    # a forked worker must not share the pooled connections of its parent (the preloading gunicorn master)
+    global _session, _session_lock
+    _session = None
+    _session_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_session)
+
+
+class RetryableStatus(requests.HTTPError):
+    pass
+
+
+def session():
+    """The requests session shared by the downloads of this process, which only use its thread safe connection pool."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def _retry_after(error, default):
+    # seconds asked for by a 429/503 answer, if given as a number
+    response = getattr(error, 'response', None)
+    value = response.headers.get('Retry-After', '') if response is not None else ''
+    return min(float(value), 60) if value.isdigit() else default
+
+
+def fetch(url, dest_dir=None, etag=None, last_modified=None, timeout=None, retries=None, backoff=None):
+    """
+    Download url into a temporary file in dest_dir. Returns (path, sha256 of the content, response headers),
+    or None if the server answers that the content is unchanged since etag / last_modified.
+    timeout, retries and backoff default to TIMEOUT, RETRIES and BACKOFF.
+    """
+    timeout = TIMEOUT if timeout is None else timeout
+    retries = RETRIES if retries is None else retries
+    backoff = BACKOFF if backoff is None else backoff
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    for attempt in range(retries + 1):
+        try:
+            return _fetch(url, dest_dir, headers, timeout)
+        except (requests.ConnectionError, requests.Timeout, RetryableStatus) as error:
+            if attempt == retries:
+                raise
+            delay = _retry_after(error, backoff * 2 ** attempt)
+            logger.warning('fetching %s failed (%s), retrying in %.1fs', url, error, delay)
+            time.sleep(delay)
+
+
+def _fetch(url, dest_dir, headers, timeout):
+    with session().get(url, headers=headers, timeout=timeout, stream=True) as response:
+        if response.status_code == 304:
+            return None
+        if response.status_code in RETRY_STATUS:
+            raise RetryableStatus('{} {}'.format(response.status_code, response.reason), response=response)
+        response.raise_for_status()
+        fd, path = tempfile.mkstemp(dir=dest_dir, suffix='.csv')
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    digest.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+        return path, digest.hexdigest(), response.headers
+
+
+# --------------------------------------------------------------------------------------------------------------
+# local stand-in for the published sources
+
+class StandInHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves the files of a directory with ETags, after `delay` seconds, answering the first `failures` with 503."""
+
+    protocol_version = 'HTTP/1.1'
+    delay = 0.0
+    failures = 0
+    _lock = threading.Lock()
+
+    def do_GET(self):
+        self._etag = None
+        time.sleep(self.delay)
+        with self._lock:
+            fail = StandInHandler.failures > 0
+            StandInHandler.failures -= fail
+        if fail:
+            self.send_error(503)
+            return
+        path = self.translate_path(self.path)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            self._etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+            if self.headers.get('If-None-Match') == self._etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+        super().do_GET()
+
+    def end_headers(self):
+        if getattr(self, '_etag', None):
+            self.send_header('ETag', self._etag)
+        super().end_headers()
+
+    def log_message(self, format, *args):
+        logger.info(format, *args)
+
+
+def serve(directory, port=0, delay=0.0, failures=0):
+    """Start a stand-in server for the files in directory on a background thread. Returns the server."""
+    StandInHandler.delay = delay
+    StandInHandler.failures = failures
+    handler = functools.partial(StandInHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, name='stand-in', daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve csv files as a local stand-in for the published sources.')
+    parser.add_argument('--dir', default=os.path.dirname(os.path.abspath(__file__)))
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds before each answer')
+    parser.add_argument('--failures', type=int, default=0, help='requests answered 503 before serving normally')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    stand_in = serve(args.dir, args.port, args.delay, args.failures)
+    print('serving {} on http://127.0.0.1:{}/'.format(args.dir, stand_in.server_port))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stand_in.shutdown()
@@ -0,0 +1,91 @@
+"""
+Memoization of figure callbacks.
+
+Figures are stored as serialized JSON in an LRU bounded both by entry count and by total payload size.
+Keys combine the callback name, its arguments and the version of the data the figure was built from,
+so a data reload (set_version with a new version) drops every cached figure.
+"""
+import functools
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import plotly.io as pio
+
+import metrics
+
+
+class FigureCache:
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set_version(self, version):
+        """Record the version of the loaded data, clearing the cache if it changed."""
+        with self._lock:
+            if version != self.version:
+                self.version = version
+                self._entries.clear()
+                self.size = 0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self.size,
+                    'max_entries': self.max_entries, 'max_bytes': self.max_bytes}
+
+    def _key(self, name, args):
+        arguments = json.dumps(args, sort_keys=True, default=str)
+        return hashlib.sha1('{}\0{}\0{}'.format(name, self.version, arguments).encode()).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def put(self, key, payload):
+        size = len(payload)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key))
+            self._entries[key] = payload
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def memoize(self, func):
+        """Decorate a callback returning a plotly figure so repeated inputs are served from the cache."""
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = self._key(func.__qualname__, args)
+            payload = self.get(key)
+            if payload is None:
+                figure = func(*args)
+                with metrics.span('serialize_figure', figure=func.__name__):
+                    payload = pio.to_json(figure, validate=False)
+                self.put(key, payload)
+            return json.loads(payload)
+        return wrapper
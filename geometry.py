@@ -0,0 +1,96 @@
+"""
+World country outlines for the choropleth map.
+
+The outlines are bundled as static GeoJSON files in assets/geo/, one per resolution, with each
+feature's id set to the country's iso3 code. The map references them by URL, so the browser
+downloads and caches the geometry once and every figure only carries iso3 codes and values.
+The coarser files are used while the map shows the whole world; zooming in switches to the
+detailed outlines.
+
+The files are generated from the Natural Earth admin 0 countries (https://www.naturalearthdata.com):
+
+* low: the 1:110m countries, simplified. Light enough for the world view, but without small states
+  such as Singapore, Bahrain, Malta or Mauritius, which are too small to see there anyway.
+* medium: the 1:50m countries, simplified.
+* high: the 1:50m countries as published.
+
+    python geometry.py                                   # downloads the Natural Earth files
+    python geometry.py ne_110m_admin_0_countries.zip ne_50m_admin_0_countries.zip
+"""
+import json
+import os
+
+# (name, Natural Earth scale, simplification tolerance in degrees, largest projection scale the resolution
+# is used up to)
+RESOLUTIONS = [
+    ('low', '110m', 0.5, 2),
+    ('medium', '50m', 0.05, 5),
+    ('high', '50m', 0, float('inf')),
+]
+NATURAL_EARTH_URL = 'https://naciscdn.org/naturalearth/{scale}/cultural/ne_{scale}_admin_0_countries.zip'
+DEFAULT_RESOLUTION = RESOLUTIONS[0][0]
+
+GEO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'geo')
+
+# Natural Earth codes that differ from the iso3 codes of the JHU data
+ISO3_FIXES = {'Kosovo': 'XKS'}
+
+
+def asset_path(resolution):
+    """Path of the resolution's file relative to the assets folder, for app.get_asset_url."""
+    return 'geo/world_{}.geojson'.format(resolution)
+
+
+def resolution_for_scale(scale):
+    """The resolution to draw at a geo projection scale (1 shows the whole world)."""
+    for name, _, _, max_scale in RESOLUTIONS:
+        if scale <= max_scale:
+            return name
+    return RESOLUTIONS[-1][0]
+
+
+def read_countries(path):
+    """Natural Earth admin 0 countries from path (or url) with their iso3 codes, without unrecognised ones."""
+    import geopandas as gpd
+
+    world = gpd.read_file(path)
+    world.columns = [column.lower() for column in world.columns]
+    # ISO_A3 is -99 for France and Norway, whose codes are only in ISO_A3_EH ("economic history")
+    iso3 = world['iso_a3_eh'] if 'iso_a3_eh' in world.columns else world['iso_a3']
+    world['iso3'] = [ISO3_FIXES.get(name, code) for name, code in zip(world['name'], iso3)]
+    return world[world['iso3'] != '-99']
+
+
+def build(out_dir=GEO_DIR, precision=2, sources=None):
+    """Write the file of every resolution; sources maps Natural Earth scales to local copies of their files."""
+    sources = sources or {}
+    countries = {}
+    os.makedirs(out_dir, exist_ok=True)
+    for name, scale, tolerance, _ in RESOLUTIONS:
+        if scale not in countries:
+            countries[scale] = read_countries(sources.get(scale) or NATURAL_EARTH_URL.format(scale=scale))
+        world = countries[scale]
+        geometry = world.geometry.simplify(tolerance, preserve_topology=True) if tolerance else world.geometry
+        features = []
+        for iso3, country, shape in zip(world['iso3'], world['name'], geometry):
+            features.append({'type': 'Feature', 'id': iso3, 'properties': {'name': country},
+                             'geometry': _rounded(shape.__geo_interface__, precision)})
+        path = os.path.join(out_dir, os.path.basename(asset_path(name)))
+        with open(path, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f, separators=(',', ':'))
+        print(path, scale, len(features), os.path.getsize(path))
+
+
+def _rounded(geometry, precision):
+    def round_coordinates(coordinates):
+        if isinstance(coordinates[0], (int, float)):
+            return [round(value, precision) for value in coordinates]
+        return [round_coordinates(part) for part in coordinates]
+    return {'type': geometry['type'], 'coordinates': round_coordinates(geometry['coordinates'])}
+
+
+if __name__ == '__main__':
+    import sys
+
+    # optional local copies of the 1:110m and 1:50m files, in that order
+    build(sources=dict(zip(['110m', '50m'], sys.argv[1:])))
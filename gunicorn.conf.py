@@ -0,0 +1,23 @@
+"""
+gunicorn settings for the dashboard, see wsgi.py:
+
+    gunicorn -c gunicorn.conf.py wsgi:server
+
+COVID_DASHBOARD_WORKERS and COVID_DASHBOARD_THREADS set the number of worker processes (default: one per
+CPU) and of threads per worker (default 4), COVID_DASHBOARD_BIND the address (default 0.0.0.0:8050).
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('COVID_DASHBOARD_BIND', '0.0.0.0:8050')
+workers = int(os.environ.get('COVID_DASHBOARD_WORKERS', multiprocessing.cpu_count()))
+# callbacks spend most of their time in python (building figures), threads mainly overlap network i/o
+threads = int(os.environ.get('COVID_DASHBOARD_THREADS', 4))
+worker_class = 'gthread' if threads > 1 else 'sync'
+
+# load the data once in the master, before forking, so the workers share it copy-on-write
+# (COVID_DASHBOARD_PRELOAD=0 loads it in every worker, sharing only the memory mapped columns)
+preload_app = os.environ.get('COVID_DASHBOARD_PRELOAD', '1') != '0'
+
+timeout = 60
+keepalive = 5
@@ -0,0 +1,267 @@
+"""
+Incremental daily ingest.
+
+New country level daily rows are appended to an append-only store (one segment of .npy columns per
+ingest, see data_store.write_columns) and the frames the dashboard shows are updated from the new
+dates only:
+
+* country_daily_df and daily_total_df get the new rows appended,
+* the new days are added to the daily/weekly/monthly rollups (see aggregates.py),
+* the country_latest rollups (latest totals, last week / last month deltas) are recomputed from the
+  last 28 days.
+
+DailyFrames objects are never modified in place; append() returns a new one, so a running app can
+swap it in while requests are still reading the previous one.
+
+Every worker process ingests on its own schedule, so ingests hold the store's lock: the first worker to
+ingest new dates downloads and writes them, the others then find them in the store.
+"""
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks on windows, where the dashboard only runs as a single process
+    fcntl = None
+
+import aggregates
+import data_store
+import metrics
+import schema
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = os.path.join(data_store.CACHE_DIR, 'daily_store')
+
+COUNTRY_COLUMN = 'Country_Region'
+WEEK_DAYS = 7
+MONTH_DAYS = 28
+
+
+class SegmentStore:
+    """Append-only store of a table as a list of column segments, each written once and never changed."""
+
+    def __init__(self, name, root=None):
+        self.directory = os.path.join(root or STORE_DIR, name)
+        self.manifest_path = os.path.join(self.directory, data_store.MANIFEST)
+        self._lock = threading.RLock()
+        self._lock_file = None
+        self._lock_depth = 0
+
+    def manifest(self):
+        manifest = data_store.read_json(self.manifest_path)
+        return manifest or {'segments': [], 'last_date': None}
+
+    def last_date(self):
+        return self.manifest()['last_date']
+
+    @contextmanager
+    def lock(self):
+        """Exclusive access to the store, across threads and processes. Reentrant."""
+        with self._lock:
+            if self._lock_depth == 0 and fcntl is not None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._lock_file = open(os.path.join(self.directory, '.lock'), 'a')
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and self._lock_file is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+                    self._lock_file.close()
+                    self._lock_file = None
+
+    def append(self, df):
+        """Write the rows of df (sorted by Date) dated after the store's last date as a new segment."""
+        with self.lock():
+            manifest = self.manifest()
+            if manifest['last_date'] is not None and len(df):
+                # another process may have written these dates already
+                df = df[df['Date'] > manifest['last_date']]
+            if len(df) == 0:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(dir=self.directory, prefix='.segment-')
+            columns = data_store.write_columns(df, tmp_dir)
+            # unique, a segment directory is never replaced
+            segment = '{:06d}-{}'.format(len(manifest['segments']), os.path.basename(tmp_dir)[len('.segment-'):])
+            os.rename(tmp_dir, os.path.join(self.directory, segment))
+            manifest['segments'].append({'name': segment, 'columns': columns, 'rows': len(df),
+                                         'first_date': schema.date_str(df['Date'].iloc[0]),
+                                         'last_date': schema.date_str(df['Date'].iloc[-1])})
+            manifest['last_date'] = schema.date_str(df['Date'].iloc[-1])
+            data_store.write_json_atomic(self.manifest_path, manifest)
+
+    def load(self, after=None, mmap=True):
+        """Rows of every segment, or only those dated after `after`."""
+        frames = [data_store.read_columns(os.path.join(self.directory, segment['name']), segment['columns'], mmap)
+                  for segment in self.manifest()['segments']
+                  if after is None or segment['last_date'] > after]
+        if not frames:
+            return None
+        df = pd.concat(frames, ignore_index=True)
+        return df if after is None else df[df['Date'] > after].reset_index(drop=True)
+
+
+# --------------------------------------------------------------------------------------------------------------
+
+def daily_totals(country_daily_rows):
+    """daily_total rows (one per date) from country level daily rows."""
+    grouped = country_daily_rows.groupby('Date', sort=True)
+    totals = grouped[['Confirmed', 'Deaths', 'Active', 'New_cases', 'New_deaths']].sum()
+    totals['Deaths_per_100'] = totals['Deaths'] / totals['Confirmed'] * 100
+    totals['No_countries'] = grouped['Confirmed'].apply(lambda confirmed: int((confirmed > 0).sum()))
+    return totals.reset_index()
+
+
+def latest_rollup(country_daily_df, country_latest_df):
+    """
+    country_latest rows recomputed from the last MONTH_DAYS days of country_daily_df. Countries without
+    rows in that window, and the static columns (iso3, Population, Continent...), come from country_latest_df.
+    """
+    last = pd.Timestamp(country_daily_df['Date'].iloc[-1])
+    dates = pd.date_range(last - pd.Timedelta(days=MONTH_DAYS), last)
+    window = country_daily_df[country_daily_df['Date'] >= dates[0]]
+    window = window.assign(**{COUNTRY_COLUMN: window[COUNTRY_COLUMN].astype(object)})
+    # countries x dates, each day carrying the latest known total
+    confirmed = window.pivot_table(index=COUNTRY_COLUMN, columns='Date', values='Confirmed', aggfunc='last')
+    confirmed = confirmed.reindex(columns=dates).ffill(axis=1)
+    deaths = window.pivot_table(index=COUNTRY_COLUMN, columns='Date', values='Deaths', aggfunc='last')
+    deaths = deaths.reindex(index=confirmed.index, columns=dates).ffill(axis=1)
+
+    # computed with the default float/object types, the schema's types are restored at the end
+    latest = schema.default_types(country_latest_df).set_index(COUNTRY_COLUMN)
+    updated = latest.reindex(latest.index.union(confirmed.index))
+    countries = confirmed.index
+    updated.loc[countries, 'Confirmed'] = confirmed[dates[-1]]
+    updated.loc[countries, 'Deaths'] = deaths[dates[-1]]
+    updated.loc[countries, 'Confirmed_last_week'] = confirmed[dates[-1 - WEEK_DAYS]].fillna(0)
+    updated.loc[countries, 'Deaths_last_week'] = deaths[dates[-1 - WEEK_DAYS]].fillna(0)
+    updated.loc[countries, 'Confirmed_last_month'] = confirmed[dates[0]].fillna(0)
+    updated.loc[countries, 'Deaths_last_month'] = deaths[dates[0]].fillna(0)
+    updated['Active'] = updated['Active'].fillna(0)
+    updated['Deaths_per_100'] = updated['Deaths'] / updated['Confirmed'] * 100
+    updated['Cases_per_million'] = updated['Confirmed'] / updated['Population'] * 1e6
+    updated['New_cases_last_week'] = updated['Confirmed'] - updated['Confirmed_last_week']
+    updated['New_deaths_last_week'] = updated['Deaths'] - updated['Deaths_last_week']
+    updated['New_cases_last_month'] = updated['Confirmed'] - updated['Confirmed_last_month']
+    updated['New_deaths_last_month'] = updated['Deaths'] - updated['Deaths_last_month']
+    return schema.apply('country_latest', updated.reset_index()[country_latest_df.columns])
+
+
+def _fill_new_counts(new_rows, country_daily_df):
+    # sources with cumulative counts only: new cases/deaths are the difference with the previous day
+    missing = [(total, new) for total, new in (('Confirmed', 'New_cases'), ('Deaths', 'New_deaths'))
+               if new not in new_rows.columns]
+    if not missing:
+        return new_rows
+    previous = country_daily_df.groupby(COUNTRY_COLUMN, sort=False, observed=True)[['Confirmed', 'Deaths']].last()
+    previous.index = previous.index.astype(object)
+    countries = new_rows[COUNTRY_COLUMN].astype(object)
+    filled = {}
+    for total, new in missing:
+        before = new_rows.groupby(countries, sort=False)[total].shift(1)
+        before = before.fillna(countries.map(previous[total])).fillna(0)
+        filled[new] = (new_rows[total] - before).clip(lower=0)
+    return new_rows.assign(**filled)
+
+
+class DailyFrames:
+    """The data frames derived from the daily sources, updated incrementally by append()."""
+
+    def __init__(self, country_daily_df, country_latest_df, daily_total_df,
+                 global_rollups=None, country_rollups=None):
+        # no-ops for frames loaded from the cache, which are already typed
+        country_daily_df = schema.apply('country_daily', country_daily_df)
+        daily_total_df = schema.apply('daily_total', daily_total_df)
+        self.country_daily_df = country_daily_df
+        self.country_latest_df = schema.apply('country_latest', country_latest_df)
+        self.daily_total_df = daily_total_df
+        if global_rollups is None:
+            with metrics.span('global_rollups'):
+                global_rollups = aggregates.Rollups(daily_total_df, key_column=None)
+        if country_rollups is None:
+            with metrics.span('country_rollups'):
+                country_rollups = aggregates.Rollups(country_daily_df, key_column=COUNTRY_COLUMN)
+        self.global_rollups = global_rollups
+        self.country_rollups = country_rollups
+
+    @property
+    def last_date(self):
+        return schema.date_str(self.daily_total_df['Date'].iloc[-1]) if len(self.daily_total_df) else None
+
+    def append(self, new_rows):
+        """A DailyFrames with the country level rows of new_rows dated after last_date added, or self if none are."""
+        new_rows = schema.apply('country_daily', new_rows)
+        last_date = self.last_date
+        if last_date is not None:
+            new_rows = new_rows[new_rows['Date'] > last_date]
+        if len(new_rows) == 0:
+            return self
+        new_rows = _fill_new_counts(new_rows.sort_values('Date', kind='stable'), self.country_daily_df)
+        if 'Deaths_per_100' not in new_rows.columns:
+            new_rows = new_rows.assign(Deaths_per_100=new_rows['Deaths'] / new_rows['Confirmed'] * 100)
+        new_rows = new_rows.reindex(columns=self.country_daily_df.columns, fill_value=0)
+        new_totals = daily_totals(new_rows)[self.daily_total_df.columns]
+        country_daily_df = schema.concat('country_daily', [self.country_daily_df, new_rows])
+        daily_total_df = schema.concat('daily_total', [self.daily_total_df, new_totals])
+
+        # the rollups only get the new days added
+        global_rollups = self.global_rollups.appended(new_totals)
+        country_rollups = self.country_rollups.appended(new_rows)
+
+        country_latest_df = latest_rollup(country_daily_df, self.country_latest_df)
+        return DailyFrames(country_daily_df, country_latest_df, daily_total_df, global_rollups, country_rollups)
+
+
+# --------------------------------------------------------------------------------------------------------------
+
+def catch_up(frames, store=None):
+    """Apply the rows ingested into the store after the dates covered by frames (e.g. after a restart)."""
+    store = store or SegmentStore('country_daily')
+    rows = store.load(after=frames.last_date)
+    return frames if rows is None else frames.append(rows)
+
+
+def fetch_new_rows(last_date, offline=None):
+    """Country level rows dated after last_date from the published country_daily.csv, or None."""
+    if offline if offline is not None else data_store.OFFLINE:
+        return None
+    try:
+        manifest = data_store.refresh('country_daily')
+    except (OSError, schema.SchemaError) as error:
+        # the cached copy is kept, the next ingest tries again
+        logger.warning('fetching new country_daily rows failed (%s)', error)
+        return None
+    df = data_store.load_cached('country_daily', manifest)
+    rows = df[df['Date'] > last_date] if last_date is not None else df
+    return rows.reset_index(drop=True) if len(rows) else None
+
+
+def ingest(frames, new_rows=None, store=None):
+    """
+    Append new_rows (or the rows fetched from the published source) to the store and return the updated
+    frames, or the same frames if there is nothing new.
+    """
+    store = store or SegmentStore('country_daily')
+    # one process at a time fetches and writes; the others wait, then take its rows from the store
+    with store.lock():
+        caught_up = catch_up(frames, store)
+        if new_rows is None:
+            new_rows = fetch_new_rows(caught_up.last_date)
+            if new_rows is None:
+                return caught_up
+        with metrics.span('append'):
+            updated = caught_up.append(new_rows)
+        if updated is not caught_up:
+            added = updated.country_daily_df.iloc[len(caught_up.country_daily_df):]
+            store.append(added.reset_index(drop=True))
+    return updated
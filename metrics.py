@@ -0,0 +1,252 @@
+"""
+Timing spans and counters for data loading and callbacks, served in the Prometheus text format.
+
+* covid_dashboard_span_seconds: data loading and processing stages (csv ingest, cache load, rollup
+  aggregates, snapshot builds, figure serialization), labelled by span.
+* covid_dashboard_callback_seconds: time in each callback function (building figures and table pages).
+* covid_dashboard_dispatch_seconds and covid_dashboard_callback_response_bytes_total: each callback as
+  dispatched by dash, including output validation and JSON serialization, and the size of its responses.
+* covid_dashboard_http_request_seconds and covid_dashboard_http_response_bytes_total: whole requests by
+  route, including response compression, and the bytes sent.
+
+instrument_app() adds a /metrics route to the Flask server. Every worker process keeps its own numbers,
+so with several workers each scrape reports the worker that served it.
+
+Set COVID_DASHBOARD_PROFILE_DIR to write a cProfile dump of every request to that directory
+(read them with pstats or snakeviz); it slows requests down and is meant for debugging only.
+"""
+import bisect
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILE_DIR = os.environ.get('COVID_DASHBOARD_PROFILE_DIR')
+
+# upper bounds in seconds, as the default buckets of the Prometheus client libraries
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield name + '_bucket', dict(labels, le=le), cumulative
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, cumulative
+
+
+class _Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Metric:
+    """A metric and its values per combination of label values."""
+
+    def __init__(self, name, documentation, kind, lock, buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.buckets = buckets
+        self._lock = lock
+        self._children = {}
+
+    def _child(self, labels):
+        key = tuple(sorted(labels.items()))
+        child = self._children.get(key)
+        if child is None:
+            child = _Histogram(self.buckets) if self.kind == 'histogram' else _Counter()
+            self._children[key] = child
+        return child
+
+    def observe(self, value, **labels):
+        with self._lock:
+            self._child(labels).observe(value)
+
+    def inc(self, value=1, **labels):
+        with self._lock:
+            self._child(labels).inc(value)
+
+    def samples(self):
+        with self._lock:
+            children = [(dict(key), child) for key, child in self._children.items()]
+            return [sample for labels, child in children for sample in child.samples(self.name, labels)]
+
+
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._gauges = []
+
+    def histogram(self, name, documentation, buckets=BUCKETS):
+        metric = Metric(name, documentation, 'histogram', self._lock, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation):
+        metric = Metric(name, documentation, 'counter', self._lock)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation, collect):
+        """A gauge read when the metrics are rendered: collect() returns a list of (labels dict, value)."""
+        self._gauges.append((name, documentation, collect))
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines += _header(metric.name, metric.documentation, metric.kind)
+            lines += [_sample(*sample) for sample in metric.samples()]
+        for name, documentation, collect in self._gauges:
+            lines += _header(name, documentation, 'gauge')
+            lines += [_sample(name, labels, value) for labels, value in collect()]
+        return '\n'.join(lines) + '\n'
+
+
+def _header(name, documentation, kind):
+    return ['# HELP {} {}'.format(name, documentation), '# TYPE {} {}'.format(name, kind)]
+
+
+def _sample(name, labels, value):
+    if labels:
+        escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for v in labels.values())
+        name += '{' + ','.join('{}="{}"'.format(k, v) for k, v in zip(labels, escaped)) + '}'
+    return '{} {}'.format(name, repr(float(value)) if isinstance(value, float) else value)
+
+
+REGISTRY = Registry()
+
+SPAN_SECONDS = REGISTRY.histogram(
+    'covid_dashboard_span_seconds', 'Duration of data loading and processing stages.')
+CALLBACK_SECONDS = REGISTRY.histogram(
+    'covid_dashboard_callback_seconds', 'Time spent in callback functions.')
+DISPATCH_SECONDS = REGISTRY.histogram(
+    'covid_dashboard_dispatch_seconds', 'Callback dispatch time, including JSON serialization of the outputs.')
+CALLBACK_RESPONSE_BYTES = REGISTRY.counter(
+    'covid_dashboard_callback_response_bytes_total', 'Bytes of serialized callback responses, before compression.')
+REQUEST_SECONDS = REGISTRY.histogram(
+    'covid_dashboard_http_request_seconds', 'HTTP request duration, including response compression.')
+RESPONSE_BYTES = REGISTRY.counter(
+    'covid_dashboard_http_response_bytes_total', 'Bytes of HTTP response bodies as sent.')
+
+
+@contextmanager
+def span(name, **labels):
+    """Record the duration of the with block (or decorated function) in covid_dashboard_span_seconds{span=name}."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        SPAN_SECONDS.observe(time.perf_counter() - start, span=name, **labels)
+
+
+def timed(func):
+    """Decorate a callback function to record its duration in covid_dashboard_callback_seconds."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            CALLBACK_SECONDS.observe(time.perf_counter() - start, callback=func.__name__)
+    return wrapper
+
+
+# --------------------------------------------------------------------------------------------------------------
+
+def _dispatch_timer(output, dispatch):
+    # dash calls callback_map[output]['callback'] with the inputs and gets back the serialized response
+    label = output.strip('.').replace('...', ',')
+
+    @functools.wraps(dispatch)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        response = dispatch(*args, **kwargs)
+        DISPATCH_SECONDS.observe(time.perf_counter() - start, output=label)
+        CALLBACK_RESPONSE_BYTES.inc(len(response) if isinstance(response, (str, bytes)) else 0, output=label)
+        return response
+    return wrapper
+
+
+class _RequestTimer:
+    """WSGI middleware timing whole requests, until the last byte of the (possibly compressed) body is sent."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        status = []
+
+        def record_status(code, headers, exc_info=None):
+            status.append(code.split(' ', 1)[0])
+            return start_response(code, headers, exc_info)
+
+        body = self.wsgi_app(environ, record_status)
+        size = 0
+        try:
+            for chunk in body:
+                size += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            labels = {'route': environ.get('covid_dashboard.route', 'unmatched'),
+                      'method': environ.get('REQUEST_METHOD', ''),
+                      'status': status[0] if status else ''}
+            REQUEST_SECONDS.observe(time.perf_counter() - start, **labels)
+            RESPONSE_BYTES.inc(size, **labels)
+
+
+def instrument_app(app, profile_dir=PROFILE_DIR):
+    """
+    Time every callback registered on the dash app and every request to its server, and serve the
+    metrics on /metrics. Call it once every callback is registered.
+    """
+    import flask
+
+    for output, spec in app.callback_map.items():
+        spec['callback'] = _dispatch_timer(output, spec['callback'])
+
+    server = app.server
+
+    @server.before_request
+    def record_route():
+        # routes rather than paths, to keep the number of label values bounded
+        rule = flask.request.url_rule
+        flask.request.environ['covid_dashboard.route'] = rule.rule if rule is not None else 'unmatched'
+
+    @server.route('/metrics')
+    def serve_metrics():
+        return flask.Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
+
+    server.wsgi_app = _RequestTimer(server.wsgi_app)
+    if profile_dir:
+        from werkzeug.middleware.profiler import ProfilerMiddleware
+
+        os.makedirs(profile_dir, exist_ok=True)
+        server.wsgi_app = ProfilerMiddleware(server.wsgi_app, stream=None, profile_dir=profile_dir)
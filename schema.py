@@ -0,0 +1,149 @@
+"""
+Column types of the dashboard's data frames.
+
+Every frame is converted once, when its csv is ingested into the cache (see data_store.py), so workers
+load already typed columns: dates as datetime64, country/continent/iso3 as categories and counts as
+int32 (floats when a column has missing values) instead of pandas' default float64 and object columns.
+
+    python schema.py  # per frame memory with default pandas dtypes and with this schema
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+DATE = 'date'
+CATEGORY = 'category'
+COUNT = 'count'
+RATE = 'rate'
+
+SCHEMAS = {
+    'country_daily': {
+        'Date': DATE, 'Country_Region': CATEGORY,
+        'Confirmed': COUNT, 'Deaths': COUNT, 'Active': COUNT, 'New_cases': COUNT, 'New_deaths': COUNT,
+        'Deaths_per_100': RATE,
+    },
+    'country_latest': {
+        'Country_Region': CATEGORY, 'iso3': CATEGORY, 'Continent': CATEGORY,
+        'Confirmed': COUNT, 'Deaths': COUNT, 'Active': COUNT, 'Population': COUNT,
+        'Confirmed_last_week': COUNT, 'Deaths_last_week': COUNT,
+        'New_cases_last_week': COUNT, 'New_deaths_last_week': COUNT,
+        'Confirmed_last_month': COUNT, 'Deaths_last_month': COUNT,
+        'New_cases_last_month': COUNT, 'New_deaths_last_month': COUNT,
+        'Deaths_per_100': RATE, 'Cases_per_million': RATE, 'Lat': RATE, 'Long': RATE,
+    },
+    'daily_total': {
+        'Date': DATE,
+        'Confirmed': COUNT, 'Deaths': COUNT, 'Active': COUNT, 'New_cases': COUNT, 'New_deaths': COUNT,
+        'No_countries': COUNT, 'Deaths_per_100': RATE,
+    },
+}
+
+_INT32 = np.iinfo(np.int32)
+
+
+class SchemaError(ValueError):
+    """A source's content is not a table of its schema, e.g. an error page served instead of the csv."""
+
+
+def validate(name, df):
+    """Raise SchemaError unless df has rows and every column of SCHEMAS[name]."""
+    missing = [column for column in SCHEMAS[name] if column not in df.columns]
+    if missing:
+        raise SchemaError('{} is missing the columns {}'.format(name, ', '.join(missing)))
+    if not len(df):
+        raise SchemaError('{} has no rows'.format(name))
+
+
+def _count(values):
+    if values.isna().any():
+        # float32 holds whole numbers exactly only up to 2**24
+        exact = not len(values) or values.abs().max() <= 2 ** 24
+        return values.astype(np.float32 if exact else np.float64)
+    if len(values) and (values.min() < _INT32.min or values.max() > _INT32.max):
+        return values.astype(np.int64)
+    return values.astype(np.int32)
+
+
+def apply(name, df):
+    """df with its columns converted to the types of SCHEMAS[name]. Columns already of that type are not copied."""
+    converted = {}
+    for column, kind in SCHEMAS[name].items():
+        if column not in df.columns:
+            continue
+        values = df[column]
+        if kind == DATE:
+            if not pd.api.types.is_datetime64_any_dtype(values):
+                converted[column] = pd.to_datetime(values, format='%Y-%m-%d')
+        elif kind == CATEGORY:
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                converted[column] = values.astype(CATEGORY)
+        elif kind == COUNT:
+            if not pd.api.types.is_integer_dtype(values) or values.dtype == np.int64:
+                counted = _count(values)
+                # float64 is kept for counts with missing values beyond float32's exact range
+                if counted.dtype != values.dtype:
+                    converted[column] = counted
+        elif values.dtype != np.float32:
+            converted[column] = values.astype(np.float32)
+    if not converted:
+        return df
+    # unlike df.assign, shares the unconverted columns (memory mapped from the cache) instead of copying them
+    return pd.DataFrame({column: converted.get(column, df[column]) for column in df.columns}, copy=False)
+
+
+def concat(name, frames):
+    """pd.concat of frames of the same source, keeping the schema's types (categories are merged)."""
+    return apply(name, pd.concat(frames, ignore_index=True))
+
+
+def date_str(value):
+    """A date as its 'YYYY-MM-DD' string, as in the csv files."""
+    return pd.Timestamp(value).strftime('%Y-%m-%d')
+
+
+# --------------------------------------------------------------------------------------------------------------
+
+def memory_usage(df):
+    """Bytes used by df, including the contents of object columns."""
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def memory_report(before, after):
+    """Rows of (name, bytes before, bytes after) for two dicts of frames keyed by name, plus a total row."""
+    rows = [(name, memory_usage(before[name]), memory_usage(after[name])) for name in before]
+    rows.append(('total', sum(row[1] for row in rows), sum(row[2] for row in rows)))
+    return rows
+
+
+def print_memory_report(rows, out=sys.stdout):
+    out.write('{:<16}{:>14}{:>14}{:>9}\n'.format('frame', 'default', 'schema', 'saved'))
+    for name, before, after in rows:
+        saved = 1 - after / before if before else 0
+        out.write('{:<16}{:>14,}{:>14,}{:>8.0%}\n'.format(name, before, after, saved))
+
+
+def default_types(df):
+    """df with the types pandas.read_csv gives the csv columns, for sources with no csv at hand."""
+    converted = {}
+    for column in df.columns:
+        values = df[column]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            converted[column] = values.dt.strftime('%Y-%m-%d').astype(object)
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            converted[column] = values.astype(object)
+        elif pd.api.types.is_numeric_dtype(values):
+            converted[column] = values.astype(np.float64)
+    return df.assign(**converted)
+
+
+if __name__ == '__main__':
+    import data_store
+
+    typed = dict(zip(data_store.SOURCES, data_store.load_frames()))
+    default = {}
+    for source in data_store.SOURCES:
+        path = os.path.join(data_store.BUNDLED_DIR, source + '.csv')
+        default[source] = pd.read_csv(path, index_col=0) if os.path.exists(path) else default_types(typed[source])
+    print_memory_report(memory_report(default, typed))
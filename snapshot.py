@@ -0,0 +1,170 @@
+"""
+Immutable snapshots of the dashboard data and their background refresh.
+
+Everything a callback or the layout needs is built once into a DataSnapshot. The app keeps the current
+snapshot in a SnapshotHolder; a refresh builds a complete new snapshot and swaps the holder's reference,
+so a request that already fetched the previous snapshot finishes with it, consistently, while the next
+requests see the new one.
+"""
+import logging
+import os
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import pandas as pd
+
+import data_store
+import ingest
+import metrics
+from summary_engine import SummaryEngine
+from table_engine import TableEngine
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks for newly published dates, 0 disables the background refresh
+REFRESH_INTERVAL = int(os.environ.get('COVID_DASHBOARD_REFRESH_INTERVAL', 60 * 60))
+
+# filter queries whose map rows are kept per snapshot
+MAX_MAP_ROWS = 64
+
+# country_latest columns as labelled in the datatable
+COUNTRY_BAR_COLUMNS = {'Country_Region': 'Country',
+                       'Confirmed': 'Confirmed cases',
+                       'Deaths_per_100': 'Fatality rate',
+                       'Cases_per_million': 'Cases/1 million population',
+                       'New_cases_last_month': '28 day cases',
+                       'New_deaths_last_month': '28 day deaths'}
+
+
+@dataclass(frozen=True)
+class DataSnapshot:
+    frames: ingest.DailyFrames
+    country_bar_df: pd.DataFrame
+    table_engine: TableEngine
+    summary_engine: SummaryEngine
+    # latest date in 'Month day year' format
+    last_update: str
+    version: str
+    loaded_at: datetime = field(default_factory=datetime.now)
+    _map_rows: dict = field(default_factory=dict, repr=False, compare=False)
+
+    @property
+    def global_rollups(self):
+        return self.frames.global_rollups
+
+    @property
+    def country_rollups(self):
+        return self.frames.country_rollups
+
+    def map_rows(self, filter_query):
+        """
+        Positions in table_engine.df of the countries drawn on the map for filter_query, and a dict giving
+        each country's position in the choropleth trace, so highlighting a selection only touches the
+        selected positions. The filter is resolved against the server side table, nothing is sent by the browser.
+        """
+        key = (filter_query or '').strip()
+        rows = self._map_rows.get(key)
+        if rows is None:
+            df = self.table_engine.df
+            positions = self.table_engine.query(key)
+            positions = positions[df['iso3'].notna().to_numpy()[positions]]
+            countries = df['Country'].to_numpy()[positions]
+            rows = (positions, {country: i for i, country in enumerate(countries)})
+            if len(self._map_rows) >= MAX_MAP_ROWS:
+                self._map_rows.clear()
+            self._map_rows[key] = rows
+        return rows
+
+    def summary(self, filter_query=''):
+        """Data card figures of the countries matching the table's filter_query, overall and per continent."""
+        key = (filter_query or '').strip()
+        # the table and the summary engine hold the rows of country_latest_df in the same order
+        mask = self.table_engine.mask(key) if key else None
+        return self.summary_engine.stats(mask), self.summary_engine.by_group(mask)
+
+    @classmethod
+    @metrics.span('snapshot')
+    def from_frames(cls, frames):
+        country_bar_df = frames.country_latest_df.rename(columns=COUNTRY_BAR_COLUMNS, copy=False)
+        last_date = frames.last_date
+        return cls(frames=frames,
+                   country_bar_df=country_bar_df,
+                   # filtering, sorting and paging of the country table happen server side
+                   table_engine=TableEngine(country_bar_df, id_column='Country'),
+                   summary_engine=SummaryEngine(frames.country_latest_df),
+                   last_update=datetime.strptime(last_date, '%Y-%m-%d').strftime('%B %d %Y'),
+                   version='{}@{}'.format(data_store.data_version(), last_date))
+
+
+class SnapshotHolder:
+    """The current snapshot. Readers call current() once per request and use that snapshot throughout."""
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def current(self):
+        return self._snapshot
+
+    def on_swap(self, listener):
+        """Call listener(snapshot) with the current snapshot and every snapshot swapped in later."""
+        self._listeners.append(listener)
+        listener(self._snapshot)
+
+    def swap(self, snapshot):
+        with self._lock:
+            # a single reference assignment, atomic for readers
+            self._snapshot = snapshot
+            for listener in self._listeners:
+                listener(snapshot)
+
+
+class BackgroundRefresher:
+    """
+    Daemon thread ingesting newly published dates every `interval` seconds and swapping in a new snapshot.
+
+    Every worker process runs one. Their ingests take turns on the store's lock (see ingest.ingest): the first
+    worker to see new dates downloads and stores them, the others then load them from the store, with at most
+    a conditional request that the source is unchanged.
+    """
+
+    def __init__(self, holder, interval=REFRESH_INTERVAL):
+        self.holder = holder
+        self.interval = interval
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def refresh(self):
+        """Ingest once. Returns True if a new snapshot was swapped in."""
+        frames = self.holder.current().frames
+        with metrics.span('refresh'):
+            updated = ingest.ingest(frames)
+        if updated is frames:
+            return False
+        self.holder.swap(DataSnapshot.from_frames(updated))
+        logger.info('data refreshed up to %s', updated.last_date)
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('data refresh failed, keeping the current snapshot')
+
+    def ensure_started(self):
+        """Start the thread in this process if it is not running (threads do not survive a worker fork)."""
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='data-refresh', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def stop(self):
+        self._stop.set()
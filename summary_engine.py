@@ -0,0 +1,84 @@
+"""
+Figures of the data card for all countries, any subset of them and per continent.
+
+Every figure on the card is a ratio of sums over countries (totals, rates, last week/month changes), so the
+counts each figure needs are laid out once as a (countries x sums) matrix, along with its column totals and
+its sums per continent. A subset of countries, such as the rows matching the table's filter, is then summed
+with one matrix product over a boolean mask, and every figure follows from those sums.
+
+Rates are weighted rather than averaged over countries: cases per million is the cases of the countries with
+a known population over their population, deaths per 100 cases is total deaths over total cases.
+"""
+import numpy as np
+
+# per country counts summed over a subset
+SUMS = ['Confirmed', 'Deaths', 'Population',
+        'New_cases_last_week', 'New_deaths_last_week', 'New_cases_last_month', 'New_deaths_last_month']
+
+
+def _ratio(numerator, denominator, scale=1.0):
+    return numerator / denominator * scale if denominator else 0.0
+
+
+class SummaryEngine:
+    """
+    Card figures of `df` (country_latest rows) and of subsets of its rows, given as boolean masks over its
+    positions, such as TableEngine.mask() of a table built from the same rows.
+    """
+
+    def __init__(self, df, group_column='Continent'):
+        columns = {column: np.nan_to_num(df[column].to_numpy(dtype=np.float64)) for column in SUMS}
+        # cases counted in cases per million, only where the population is known
+        columns['Confirmed_with_population'] = np.where(columns['Population'] > 0, columns['Confirmed'], 0)
+        self._index = {column: i for i, column in enumerate(columns)}
+        self.values = np.column_stack(list(columns.values()))
+        groups = df[group_column].astype('category')
+        self.groups = [str(group) for group in groups.cat.categories]
+        # (countries x groups), 1 where the country is in the group
+        self.membership = (groups.cat.codes.to_numpy()[:, None] == np.arange(len(self.groups))).astype(np.float64)
+        self.totals = self.values.sum(axis=0)
+        self.group_totals = self.membership.T @ self.values
+        self.group_countries = self.membership.sum(axis=0)
+
+    def __len__(self):
+        return len(self.values)
+
+    def _stats(self, sums, countries):
+        def total(column):
+            return int(round(sums[self._index[column]]))
+
+        cases, deaths = total('Confirmed'), total('Deaths')
+        stats = {
+            'countries': int(countries),
+            'global_total_cases': cases,
+            'global_total_deaths': deaths,
+            'cases_per_million': int(_ratio(sums[self._index['Confirmed_with_population']],
+                                            sums[self._index['Population']], 1e6)),
+            'deaths_per_100': _ratio(deaths, cases, 100),
+            'cases_last_month': total('New_cases_last_month'),
+            'deaths_last_month': total('New_deaths_last_month'),
+            'cases_last_week': total('New_cases_last_week'),
+            'deaths_last_week': total('New_deaths_last_week'),
+        }
+        stats['cases_one_month_change_pc'] = _ratio(stats['cases_last_month'], cases, 100)
+        stats['deaths_one_month_change_pc'] = _ratio(stats['deaths_last_month'], deaths, 100)
+        stats['cases_one_week_change_pc'] = _ratio(stats['cases_last_week'], cases, 100)
+        stats['deaths_one_week_change_pc'] = _ratio(stats['deaths_last_week'], deaths, 100)
+        return stats
+
+    def stats(self, mask=None):
+        """Card figures of the rows in mask (every row if None)."""
+        if mask is None:
+            return self._stats(self.totals, len(self))
+        weights = mask.astype(np.float64)
+        return self._stats(weights @ self.values, weights.sum())
+
+    def by_group(self, mask=None):
+        """Card figures of the rows in mask per group (continent), for the groups with rows in mask."""
+        if mask is None:
+            sums, countries = self.group_totals, self.group_countries
+        else:
+            selected = self.membership * mask[:, None]
+            sums, countries = selected.T @ self.values, selected.sum(axis=0)
+        return {group: self._stats(sums[i], countries[i])
+                for i, group in enumerate(self.groups) if countries[i]}
@@ -0,0 +1,300 @@
+"""
+Server side filtering, sorting and paging for a DataTable in 'custom' mode.
+
+filter_query strings written by the DataTable, e.g.
+
+    {Country} icontains "united" && ({Deaths} > 1000 || {Fatality rate} is blank)
+
+are parsed once into a tree and evaluated as vectorized boolean masks over the frame's columns.
+Each column's ascending and descending orders are computed once, so a single column sort is a
+mask lookup over a pre-sorted index rather than a sort of the filtered rows.
+"""
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# relational operators, as written by the DataTable or typed in its filter cells.
+# 'i' and 's' prefixes make text comparisons case insensitive / sensitive.
+_OPERATORS = {
+    '=': 'eq', 'eq': 'eq', '!=': 'ne', 'ne': 'ne',
+    '<': 'lt', 'lt': 'lt', '<=': 'le', 'le': 'le',
+    '>': 'gt', 'gt': 'gt', '>=': 'ge', 'ge': 'ge',
+    'contains': 'contains', 'datestartswith': 'datestartswith',
+}
+
+_TOKEN = re.compile(r'''
+    \s*(?:
+      (?P<column>\{(?:[^}\\]|\\.)*\})
+    | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|`(?:[^`\\]|\\.)*`)
+    | (?P<logical>&&|\|\||\band\b|\bor\b)
+    | (?P<unary>is\s+(?:blank|nil|num|str)\b)
+    | (?P<operator><=|>=|!=|=|<|>|[is]?(?:eq|ne|lt|le|gt|ge|contains)\b|datestartswith\b)
+    | (?P<not>!)
+    | (?P<paren>[()])
+    | (?P<word>[^\s()]+)
+    )''', re.VERBOSE | re.IGNORECASE)
+
+
+class FilterSyntaxError(ValueError):
+    pass
+
+
+def _unquote(text):
+    return re.sub(r'\\(.)', r'\1', text[1:-1])
+
+
+def tokenize(filter_query):
+    tokens = []
+    position = 0
+    filter_query = filter_query.rstrip()
+    while position < len(filter_query):
+        match = _TOKEN.match(filter_query, position)
+        if match is None:
+            raise FilterSyntaxError('cannot parse {!r}'.format(filter_query[position:]))
+        position = match.end()
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'column':
+            tokens.append(('column', _unquote(text)))
+        elif kind == 'string':
+            tokens.append(('value', _unquote(text)))
+        elif kind == 'word':
+            tokens.append(('value', _number(text)))
+        elif kind == 'logical':
+            tokens.append(('logical', 'and' if text.lower() in ('&&', 'and') else 'or'))
+        elif kind == 'operator' and tokens and tokens[-1][0] == 'operator':
+            # a value that happens to spell an operator, e.g. {Country} contains le
+            tokens.append(('value', text))
+        elif kind == 'unary':
+            tokens.append(('unary', ' '.join(text.lower().split())))
+        else:
+            tokens.append((kind, text.lower()))
+    return tokens
+
+
+def _number(text):
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return float(text)
+        except ValueError:
+            return text
+
+
+def parse(filter_query):
+    """Parse a DataTable filter_query into a nested tuple tree, or None for an empty query."""
+    tokens = tokenize(filter_query or '')
+    if not tokens:
+        return None
+    tree, position = _parse_or(tokens, 0)
+    if position != len(tokens):
+        raise FilterSyntaxError('unexpected {!r}'.format(tokens[position][1]))
+    return tree
+
+
+def _parse_or(tokens, position):
+    left, position = _parse_and(tokens, position)
+    while position < len(tokens) and tokens[position] == ('logical', 'or'):
+        right, position = _parse_and(tokens, position + 1)
+        left = ('or', left, right)
+    return left, position
+
+
+def _parse_and(tokens, position):
+    left, position = _parse_term(tokens, position)
+    while position < len(tokens) and tokens[position] == ('logical', 'and'):
+        right, position = _parse_term(tokens, position + 1)
+        left = ('and', left, right)
+    return left, position
+
+
+def _parse_term(tokens, position):
+    if position >= len(tokens):
+        raise FilterSyntaxError('incomplete filter')
+    kind, text = tokens[position]
+    if kind == 'not':
+        operand, position = _parse_term(tokens, position + 1)
+        return ('not', operand), position
+    if (kind, text) == ('paren', '('):
+        tree, position = _parse_or(tokens, position + 1)
+        if position >= len(tokens) or tokens[position] != ('paren', ')'):
+            raise FilterSyntaxError('missing )')
+        return tree, position + 1
+    if kind != 'column':
+        raise FilterSyntaxError('expected a {column}, got %r' % (text,))
+    column = text
+    if position + 1 >= len(tokens):
+        raise FilterSyntaxError('missing operator after {%s}' % column)
+    kind, operator = tokens[position + 1]
+    if kind == 'unary':
+        return ('unary', column, operator), position + 2
+    if kind != 'operator' or position + 2 >= len(tokens) or tokens[position + 2][0] != 'value':
+        raise FilterSyntaxError('expected an operator and a value after {%s}' % column)
+    case = None
+    if operator not in _OPERATORS and operator[0] in 'is':
+        case, operator = operator[0], operator[1:]
+    return ('compare', column, _OPERATORS[operator], case, tokens[position + 2][1]), position + 3
+
+
+# --------------------------------------------------------------------------------------------------------------
+
+class TableEngine:
+    """
+    Filter, sort and page `df` for a DataTable. Rows are identified by position in `df`;
+    `id_column` is copied into each record's 'id' so the table can report selected_row_ids.
+    """
+
+    def __init__(self, df, id_column=None, max_cached_queries=64):
+        self.df = df.reset_index(drop=True)
+        self.id_column = id_column
+        self.max_cached_queries = max_cached_queries
+        self._orders = {}
+        self._lower = {}
+        self._masks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.df)
+
+    # filtering
+    def mask(self, filter_query):
+        """Boolean mask of the rows matching filter_query (cached for recently used queries)."""
+        filter_query = (filter_query or '').strip()
+        with self._lock:
+            mask = self._masks.get(filter_query)
+            if mask is not None:
+                self._masks.move_to_end(filter_query)
+                return mask
+        try:
+            tree = parse(filter_query)
+            mask = np.ones(len(self.df), dtype=bool) if tree is None else self._evaluate(tree)
+        except FilterSyntaxError:
+            # like the native table, an invalid query filters nothing
+            mask = np.ones(len(self.df), dtype=bool)
+        mask.setflags(write=False)
+        with self._lock:
+            self._masks[filter_query] = mask
+            while len(self._masks) > self.max_cached_queries:
+                self._masks.popitem(last=False)
+        return mask
+
+    def _evaluate(self, tree):
+        kind = tree[0]
+        if kind == 'and':
+            return self._evaluate(tree[1]) & self._evaluate(tree[2])
+        if kind == 'or':
+            return self._evaluate(tree[1]) | self._evaluate(tree[2])
+        if kind == 'not':
+            return ~self._evaluate(tree[1])
+        column = tree[1]
+        if column not in self.df.columns:
+            raise FilterSyntaxError('unknown column {%s}' % column)
+        values = self.df[column]
+        if kind == 'unary':
+            return self._unary(values, tree[2])
+        return self._compare(column, values, *tree[2:])
+
+    @staticmethod
+    def _unary(values, operator):
+        missing = values.isna().to_numpy()
+        if operator == 'is nil':
+            return missing
+        if operator == 'is blank':
+            if pd.api.types.is_numeric_dtype(values):
+                return missing
+            return missing | (values.astype(str).str.strip() == '').to_numpy()
+        if operator == 'is num':
+            return np.full(len(values), pd.api.types.is_numeric_dtype(values)) & ~missing
+        return np.full(len(values), not pd.api.types.is_numeric_dtype(values)) & ~missing
+
+    def _lowered(self, column, values):
+        lowered = self._lower.get(column)
+        if lowered is None:
+            lowered = self._lower[column] = values.astype(str).str.lower()
+        return lowered
+
+    def _compare(self, column, values, operator, case, value):
+        numeric = pd.api.types.is_numeric_dtype(values)
+        missing = values.isna().to_numpy()
+        if numeric and not isinstance(value, str) and operator not in ('contains', 'datestartswith'):
+            array = values.to_numpy()
+            result = {
+                'eq': np.equal, 'ne': np.not_equal, 'lt': np.less, 'le': np.less_equal,
+                'gt': np.greater, 'ge': np.greater_equal,
+            }[operator](array, value)
+            # NaN is not equal to anything, but like in the text comparisons missing values match nothing
+            return result & ~missing
+        if numeric:
+            # text operators on numbers compare against the displayed value
+            text, value = values.astype(str), str(value)
+        elif case == 'i':
+            text, value = self._lowered(column, values), str(value).lower()
+        else:
+            text, value = values.astype(str), str(value)
+        if operator == 'contains':
+            result = text.str.contains(value, regex=False).to_numpy(dtype=bool)
+        elif operator == 'datestartswith':
+            result = text.str.startswith(value).to_numpy(dtype=bool)
+        else:
+            result = {
+                'eq': text.__eq__, 'ne': text.__ne__, 'lt': text.__lt__, 'le': text.__le__,
+                'gt': text.__gt__, 'ge': text.__ge__,
+            }[operator](value).to_numpy(dtype=bool)
+        return result & ~missing
+
+    # sorting
+    def _order(self, column, ascending):
+        """Row positions of the whole frame sorted by `column`, missing values last."""
+        key = (column, ascending)
+        order = self._orders.get(key)
+        if order is None:
+            if column not in self.df.columns:
+                raise FilterSyntaxError('unknown column {%s}' % column)
+            order = (self.df[column].sort_values(ascending=ascending, kind='stable', na_position='last')
+                     .index.to_numpy())
+            order.setflags(write=False)
+            self._orders[key] = order
+        return order
+
+    def _rank(self, column, ascending):
+        key = (column, ascending, 'rank')
+        rank = self._orders.get(key)
+        if rank is None:
+            rank = np.empty(len(self.df), dtype=np.int64)
+            rank[self._order(column, ascending)] = np.arange(len(self.df))
+            self._orders[key] = rank
+        return rank
+
+    def query(self, filter_query='', sort_by=None):
+        """Positions of the rows matching filter_query, in the order given by the DataTable's sort_by."""
+        mask = self.mask(filter_query)
+        sort_by = sort_by or []
+        if not sort_by:
+            return np.flatnonzero(mask)
+        first = sort_by[0]
+        order = self._order(first['column_id'], first['direction'] == 'asc')
+        positions = order[mask[order]]
+        if len(sort_by) > 1:
+            ranks = [self._rank(s['column_id'], s['direction'] == 'asc')[positions] for s in reversed(sort_by)]
+            positions = positions[np.lexsort(ranks)]
+        return positions
+
+    # paging
+    def records(self, positions):
+        records = self.df.iloc[positions].to_dict('records')
+        if self.id_column is not None:
+            for record in records:
+                record['id'] = record[self.id_column]
+        return records
+
+    def page(self, page_current, page_size, filter_query='', sort_by=None):
+        """Records of one page of the filtered and sorted table, and the number of pages."""
+        positions = self.query(filter_query, sort_by)
+        page_current = page_current or 0
+        start = page_current * page_size
+        page_count = max(1, -(-len(positions) // page_size))
+        return self.records(positions[start:start + page_size]), page_count
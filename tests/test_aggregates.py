@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from aggregates import Rollups
+
+# pd.Grouper frequencies of the granularities, whose labels Rollups reproduces
+FREQUENCIES = {'daily': 'D', 'weekly': 'W', 'monthly': 'ME'}
+
+
+def daily_rows(countries=('A', 'B', 'C'), days=100, start='2020-01-22', seed=0):
+    """Country level daily rows, starting mid-week and mid-month."""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for country in countries:
+        new_cases = rng.integers(0, 1000, days)
+        new_deaths = rng.integers(0, 20, days)
+        frames.append(pd.DataFrame({
+            'Date': pd.date_range(start, periods=days), 'Country_Region': country,
+            'Confirmed': new_cases.cumsum(), 'Deaths': new_deaths.cumsum(),
+            'New_cases': new_cases, 'New_deaths': new_deaths,
+        }))
+    return pd.concat(frames, ignore_index=True).sort_values('Date', kind='stable', ignore_index=True)
+
+
+def grouped(df, granularity):
+    """The charts' periods as they were computed before Rollups, with pd.Grouper."""
+    totals = df.groupby('Date')[['Confirmed', 'Deaths', 'New_cases', 'New_deaths']].sum().reset_index()
+    return totals.groupby(pd.Grouper(key='Date', freq=FREQUENCIES[granularity])).agg(
+        {'Confirmed': 'max', 'Deaths': 'max', 'New_cases': 'sum', 'New_deaths': 'sum'}).reset_index()
+
+
+def assert_same(frame, expected):
+    pd.testing.assert_frame_equal(frame.reset_index(drop=True), expected.reset_index(drop=True),
+                                  check_dtype=False, check_freq=False)
+
+
+@pytest.mark.parametrize('granularity', list(FREQUENCIES))
+def test_matches_grouper(granularity):
+    df = daily_rows()
+    totals = df.groupby('Date', as_index=False)[['Confirmed', 'Deaths', 'New_cases', 'New_deaths']].sum()
+    assert_same(Rollups(totals, key_column=None).frame(granularity), grouped(df, granularity))
+    rollups = Rollups(df)
+    assert_same(rollups.frame(granularity), grouped(df, granularity))
+    assert_same(rollups.frame(granularity, keys=['A', 'C', 'unknown']),
+                grouped(df[df['Country_Region'].isin(['A', 'C'])], granularity))
+
+
+def test_missing_days_keep_totals():
+    df = daily_rows(countries=['A'])
+    gap = df['Date'] == pd.Timestamp('2020-02-05')
+    frame = Rollups(df[~gap]).frame('daily')
+    day = frame[frame['Date'] == pd.Timestamp('2020-02-05')].iloc[0]
+    assert day['Confirmed'] == df['Confirmed'][df['Date'] == pd.Timestamp('2020-02-04')].iloc[0]
+    assert day['New_cases'] == 0
+
+
+@pytest.mark.parametrize('granularity', ['weekly', 'monthly'])
+def test_start_end_cut_partial_periods(granularity):
+    df = daily_rows()
+    # a wednesday and a thursday, both mid-month
+    start, end = pd.Timestamp('2020-02-12'), pd.Timestamp('2020-04-09')
+    frame = Rollups(df).frame(granularity, start, end)
+    # the first and last periods only cover the days within the range, still labelled with their period end
+    assert_same(frame, grouped(df[(df['Date'] >= start) & (df['Date'] <= end)], granularity))
+    assert frame['Date'].iloc[-1] >= end
+    assert Rollups(df).frame(granularity, end, start).empty
+
+
+def test_max_points_merges_periods():
+    df = daily_rows(countries=['A'], days=95)
+    frame = Rollups(df).frame('daily', max_points=10)
+    # 95 days in merges of ceil(95 / 10) = 10 days, the last one of 5
+    assert len(frame) == 10
+    sizes = np.array([10] * 9 + [5])
+    ends = np.cumsum(sizes) - 1
+    assert list(frame['Date']) == list(df['Date'].iloc[ends])
+    assert list(frame['Confirmed']) == list(df['Confirmed'].iloc[ends])
+    # new counts are averaged per (daily) period, so they keep the scale of a day
+    sums = np.add.reduceat(df['New_cases'].to_numpy(), np.concatenate([[0], ends[:-1] + 1]))
+    np.testing.assert_allclose(frame['New_cases'], sums / sizes)
+    assert len(Rollups(df).frame('weekly', max_points=100)) == len(grouped(df, 'weekly'))
+
+
+def test_appended_matches_full_build():
+    df = daily_rows(days=80)
+    cut = pd.Timestamp('2020-03-01')
+    # a country first seen in the appended days
+    late = daily_rows(countries=['D'], days=10, start='2020-03-20', seed=1)
+    full = pd.concat([df, late], ignore_index=True).sort_values('Date', kind='stable', ignore_index=True)
+    base = Rollups(full[full['Date'] <= cut])
+    before = base.frame('weekly')
+    # days already held are skipped
+    appended = base.appended(full[full['Date'] <= pd.Timestamp('2020-03-15')]).appended(full)
+    rebuilt = Rollups(full)
+    assert appended.keys == rebuilt.keys
+    for granularity in FREQUENCIES:
+        assert_same(appended.frame(granularity), rebuilt.frame(granularity))
+        assert_same(appended.frame(granularity, keys=['D']), rebuilt.frame(granularity, keys=['D']))
+    # the rollups appended to are not modified
+    assert_same(base.frame('weekly'), before)
+    assert 'D' not in base
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+import requests
+
+import data_store
+import fetch
+import schema
+
+CSV = ',Date,Confirmed,Deaths,Active,New_cases,New_deaths,No_countries,Deaths_per_100\n' \
+      '0,2023-03-09,10,1,0,1,0,1,10.0\n'
+
+
+@pytest.fixture
+def stand_in(tmp_path):
+    source_dir = tmp_path / 'source'
+    source_dir.mkdir()
+    (source_dir / 'daily_total.csv').write_text(CSV)
+    server = fetch.serve(str(source_dir))
+    yield 'http://127.0.0.1:{}/'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+    fetch.StandInHandler.failures = 0
+
+
+def test_download_then_not_modified(stand_in, tmp_path):
+    path, sha256, headers = fetch.fetch(stand_in + 'daily_total.csv', dest_dir=str(tmp_path))
+    with open(path) as f:
+        assert f.read() == CSV
+    os.remove(path)
+    assert headers['ETag']
+    assert fetch.fetch(stand_in + 'daily_total.csv', dest_dir=str(tmp_path), etag=headers['ETag']) is None
+
+
+def test_retries_unavailable(stand_in, tmp_path):
+    fetch.StandInHandler.failures = 1
+    path, _, _ = fetch.fetch(stand_in + 'daily_total.csv', dest_dir=str(tmp_path), backoff=0)
+    os.remove(path)
+    assert fetch.StandInHandler.failures == 0
+
+    fetch.StandInHandler.failures = 3
+    with pytest.raises(requests.HTTPError):
+        fetch.fetch(stand_in + 'daily_total.csv', dest_dir=str(tmp_path), retries=2, backoff=0)
+
+
+def test_not_found_is_not_retried(stand_in, tmp_path):
+    with pytest.raises(requests.HTTPError):
+        fetch.fetch(stand_in + 'missing.csv', dest_dir=str(tmp_path), backoff=10)
+
+
+def test_refresh_keeps_cache_on_failure(stand_in, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    monkeypatch.setattr(fetch, 'RETRIES', 1)
+    monkeypatch.setattr(fetch, 'BACKOFF', 0)
+    manifest = data_store.refresh_stale(['daily_total'], cache_dir=cache_dir, base_url=stand_in)['daily_total']
+    assert manifest['etag']
+
+    # unchanged: a 304 only updates the check time
+    checked = data_store.refresh_stale(['daily_total'], cache_dir=cache_dir, max_age=0,
+                                       base_url=stand_in)['daily_total']
+    assert checked['version'] == manifest['version']
+    assert checked['checked_at'] >= manifest['checked_at']
+
+    fetch.StandInHandler.failures = 10
+    kept = data_store.refresh_stale(['daily_total'], cache_dir=cache_dir, max_age=0,
+                                    base_url=stand_in)['daily_total']
+    assert kept['version'] == manifest['version']
+    assert len(data_store.load_cached('daily_total', kept, cache_dir)) == 1
+
+
+def test_refresh_keeps_cache_on_bad_content(stand_in, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    manifest = data_store.refresh_stale(['daily_total'], cache_dir=cache_dir, base_url=stand_in)['daily_total']
+
+    # an error page served with a 200 is not a new version of the source
+    for content in ('<html>rate limited</html>\n', CSV.splitlines()[0] + '\n', 'a,b\n"1,2\n'):
+        (tmp_path / 'source' / 'daily_total.csv').write_text(content)
+        kept = data_store.refresh_stale(['daily_total'], cache_dir=cache_dir, max_age=0,
+                                        base_url=stand_in)['daily_total']
+        assert kept['version'] == manifest['version']
+        assert len(data_store.load_cached('daily_total', kept, cache_dir)) == 1
+
+    with pytest.raises(schema.SchemaError):
+        data_store.refresh_stale(['daily_total'], cache_dir=str(tmp_path / 'empty'), base_url=stand_in)
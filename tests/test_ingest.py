@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import ingest
+import schema
+
+COUNTRIES = {'A': ('AAA', 'Europe', 1e6), 'B': ('BBB', 'Asia', 5e6), 'C': ('CCC', 'Africa', 2e5)}
+CUT = pd.Timestamp('2020-03-01')
+
+
+@pytest.fixture
+def rows():
+    """Country level daily rows of three countries over 90 days, one of them missing a few days."""
+    rng = np.random.default_rng(0)
+    frames = []
+    for country in COUNTRIES:
+        new_cases, new_deaths = rng.integers(0, 1000, 90), rng.integers(0, 20, 90)
+        frames.append(pd.DataFrame({
+            'Date': pd.date_range('2020-01-22', periods=90), 'Country_Region': country,
+            'Confirmed': new_cases.cumsum(), 'Deaths': new_deaths.cumsum(), 'Active': 0,
+            'New_cases': new_cases, 'New_deaths': new_deaths,
+        }))
+    df = pd.concat(frames, ignore_index=True).sort_values('Date', kind='stable', ignore_index=True)
+    df['Deaths_per_100'] = df['Deaths'] / df['Confirmed'] * 100
+    gaps = (df['Country_Region'] == 'C') & df['Date'].between('2020-03-10', '2020-03-12')
+    return schema.apply('country_daily', df[~gaps].reset_index(drop=True))
+
+
+def static_latest():
+    columns = list(schema.SCHEMAS['country_latest'])
+    latest = pd.DataFrame(0.0, index=range(len(COUNTRIES)), columns=columns)
+    latest['Country_Region'] = list(COUNTRIES)
+    latest['iso3'], latest['Continent'], latest['Population'] = zip(*COUNTRIES.values())
+    return schema.apply('country_latest', latest)
+
+
+def frames_of(country_daily_df):
+    latest = ingest.latest_rollup(country_daily_df, static_latest())
+    return ingest.DailyFrames(country_daily_df, latest, ingest.daily_totals(country_daily_df))
+
+
+def assert_same_frames(frames, expected):
+    for name in ('country_daily_df', 'country_latest_df', 'daily_total_df'):
+        pd.testing.assert_frame_equal(getattr(frames, name), getattr(expected, name),
+                                      check_dtype=False, check_categorical=False)
+    for name in ('global_rollups', 'country_rollups'):
+        for granularity in ('daily', 'weekly', 'monthly'):
+            pd.testing.assert_frame_equal(getattr(frames, name).frame(granularity),
+                                          getattr(expected, name).frame(granularity))
+    assert frames.country_rollups.keys == expected.country_rollups.keys
+
+
+def test_append_matches_full_rebuild(rows):
+    base = frames_of(rows[rows['Date'] <= CUT])
+    updated = base.append(rows[rows['Date'] <= '2020-03-15']).append(rows)
+    assert_same_frames(updated, frames_of(rows))
+    assert updated.last_date == '2020-04-20'
+    # nothing new: the same frames
+    assert updated.append(rows) is updated
+
+
+def test_append_fills_new_counts(rows):
+    base = frames_of(rows[rows['Date'] <= CUT])
+    # sources with cumulative counts only
+    cumulative = rows[rows['Date'] > CUT].drop(columns=['New_cases', 'New_deaths', 'Deaths_per_100'])
+    # new counts are the differences of the totals, after a country's missing days those of several days
+    countries = rows.groupby('Country_Region', observed=True)
+    derived = {'New_cases': countries['Confirmed'].diff(), 'New_deaths': countries['Deaths'].diff()}
+    expected = rows.assign(**{column: values.where(rows['Date'] > CUT, rows[column]).astype(np.int32)
+                              for column, values in derived.items()})
+    assert_same_frames(base.append(cumulative), frames_of(expected))
+
+
+def test_catch_up_matches_full_rebuild(rows, tmp_path):
+    store = ingest.SegmentStore('country_daily', root=str(tmp_path))
+    store.append(rows[(rows['Date'] > CUT) & (rows['Date'] <= '2020-03-15')].reset_index(drop=True))
+    store.append(rows[rows['Date'] > CUT].reset_index(drop=True))
+    assert_same_frames(ingest.catch_up(frames_of(rows[rows['Date'] <= CUT]), store), frames_of(rows))
+
+
+def test_segments_stored_twice_are_deduplicated(rows, tmp_path):
+    new_rows = rows[rows['Date'] > CUT].reset_index(drop=True)
+    # two workers, each with its own SegmentStore on the same directory, storing the same dates
+    first = ingest.SegmentStore('country_daily', root=str(tmp_path))
+    second = ingest.SegmentStore('country_daily', root=str(tmp_path))
+    first.append(new_rows[new_rows['Date'] <= '2020-03-15'])
+    second.append(new_rows[new_rows['Date'] <= '2020-03-15'])
+    second.append(new_rows)
+    first.append(new_rows)
+    segments = first.manifest()['segments']
+    assert [segment['last_date'] for segment in segments] == ['2020-03-15', '2020-04-20']
+    assert len({segment['name'] for segment in segments}) == 2
+    stored = first.load()
+    assert len(stored) == len(new_rows)
+    assert not stored.duplicated(['Date', 'Country_Region']).any()
+    assert len(first.load(after='2020-03-15')) == (new_rows['Date'] > '2020-03-15').sum()
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from table_engine import FilterSyntaxError, TableEngine, parse
+
+FRAME = pd.DataFrame({
+    'Country': ['United States', 'United Kingdom', 'France', 'Nauru', None],
+    'Deaths': [1100000, 220000, 160000, 1, np.nan],
+    'Fatality rate': [1.1, 0.9, np.nan, 0.02, np.nan],
+})
+
+
+def rows(filter_query):
+    return list(np.flatnonzero(TableEngine(FRAME).mask(filter_query)))
+
+
+def test_parse_tree():
+    assert parse('') is None
+    assert parse('{Deaths} > 1000') == ('compare', 'Deaths', 'gt', None, 1000)
+    assert parse('{Deaths} ge 1.5') == ('compare', 'Deaths', 'ge', None, 1.5)
+    assert parse('{Country} icontains "united"') == ('compare', 'Country', 'contains', 'i', 'united')
+    assert parse('{Fatality rate} is  Blank') == ('unary', 'Fatality rate', 'is blank')
+    # && binds tighter than ||
+    assert parse('{a} = 1 || {b} = 2 && {c} = 3') == (
+        'or', ('compare', 'a', 'eq', None, 1),
+        ('and', ('compare', 'b', 'eq', None, 2), ('compare', 'c', 'eq', None, 3)))
+    assert parse('!({a} = 1)') == ('not', ('compare', 'a', 'eq', None, 1))
+
+
+def test_parse_quoting():
+    assert parse(r'{Country} = "Cote d\"Ivoire"') == ('compare', 'Country', 'eq', None, 'Cote d"Ivoire')
+    assert parse(r'{Odd \} name} = `x`') == ('compare', 'Odd } name', 'eq', None, 'x')
+    # a value spelling an operator is a value
+    assert parse('{Country} contains le') == ('compare', 'Country', 'contains', None, 'le')
+
+
+@pytest.mark.parametrize('filter_query', ['{Deaths} >', '{Deaths}', '({Deaths} > 1', '{Deaths} > 1 &&', '> 1',
+                                          '{Deaths} > 1 2'])
+def test_parse_errors(filter_query):
+    with pytest.raises(FilterSyntaxError):
+        parse(filter_query)
+
+
+def test_mask():
+    assert rows('') == [0, 1, 2, 3, 4]
+    assert rows('{Deaths} > 200000') == [0, 1]
+    assert rows('{Country} icontains "UNITED"') == [0, 1]
+    assert rows('{Country} contains "UNITED"') == []
+    # missing values match no comparison, only is blank / is nil
+    assert rows('{Country} ne "France"') == [0, 1, 3]
+    assert rows('{Deaths} ne 1') == [0, 1, 2]
+    assert rows('{Fatality rate} != 0.9') == [0, 3]
+    assert rows('{Fatality rate} is blank') == [2, 4]
+    assert rows('{Country} contains "United" && !({Deaths} < 1000000) || {Fatality rate} is nil') == [0, 2, 4]
+    # text operators on numbers compare against the displayed value
+    assert rows('{Deaths} contains "220"') == [1]
+
+
+def test_invalid_query_filters_nothing():
+    assert rows('{Deaths} >') == [0, 1, 2, 3, 4]
+    assert rows('{Unknown} > 1') == [0, 1, 2, 3, 4]
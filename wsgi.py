@@ -0,0 +1,17 @@
+"""
+Production entry point, exposing the dashboard's Flask server to a WSGI server:
+
+    gunicorn -c gunicorn.conf.py wsgi:server
+    uwsgi --http :8050 --module wsgi --master --processes 4 --threads 4
+
+The data is loaded when this module is imported. Loaded before the workers fork (gunicorn's preload_app,
+uwsgi without lazy-apps), the frames, rollups and lookup tables are shared copy-on-write by every worker; the
+source columns are also memory mapped from the column cache (see data_store.py), so even workers loading
+the data themselves share a single copy in the page cache. That holds with pandas 2; pandas 1.x copies
+columns of the same type into one block when it builds a frame.
+"""
+from CovidDashboard import app
+
+server = app.server
+# the callable name uwsgi looks for by default
+application = server